@@ -0,0 +1,431 @@
+"""Module providing an asyncio client for the chat server, for scripts and the terminal client"""
+import asyncio
+import collections
+import socket
+import time
+import os
+from protocol import (ENCODING, HEADERSIZE, FILE_MSG, TEXT_MSG, FILE_INFO_MSG, HELLO_MSG,
+                      CODECS_MSG, PING_MSG, LEGACY, BINARY, COMPRESSED, VERSION, HELLO, CODECS,
+                      COMPRESS_MIN_SIZE, CODEC_ERRORS, encode_header, decode_header, file_digest,
+                      choose_codec, decompress, make_decompressor)
+
+# Most bytes taken from a connection's stream at once, also its buffer limit
+READ_CHUNK = 1 << 20
+
+# Downloads are written through a buffer of this size, so the disk sees large
+# writes however small the pieces arriving from the network are
+WRITE_BUFFER = 1 << 20
+
+# Seconds between progress reports of a download
+PROGRESS_INTERVAL = 0.1
+
+class Progress:
+    """Class representing the progress of a download, reported at most once per interval"""
+    def __init__(self, total, callback=None, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.callback = callback
+        self.interval = interval
+        self.started = time.monotonic()
+        self.reported = 0
+
+    def update(self, done):
+        """Function to report done bytes of the total, unless the last report was too recent"""
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        # Always report the end, so a progress bar is left full
+        if done < self.total and now - self.reported < self.interval:
+            return
+        self.reported = now
+        rate = done / max(now - self.started, 1e-6)
+        self.callback(done / self.total if self.total else 1.0, rate)
+
+class Client:
+    """Class representing a connection to the chat server, driven by an asyncio event loop"""
+    def __init__(self, username='John_Pork', host='127.0.0.1', port=1234, connections=1,
+                 legacy=False, folder_name=None, on_message=None, on_progress=None,
+                 on_file=None, on_close=None, progress_interval=PROGRESS_INTERVAL):
+        self.username = username
+        self.address = (host, port)
+        # Framing version offered to the server, lowered to whatever it agrees to
+        self.version = LEGACY if legacy else VERSION
+        # Codec used to compress large messages, if the server can decode one of ours
+        self.codec = None
+        # Number of connections used to download a file in parallel
+        self.connections = connections
+        # Downloads are saved in a folder named after the user unless told otherwise
+        self.folder_name = folder_name or username
+
+        # Setup callbacks, on_message(text), on_progress(progress, bytes_per_second),
+        # on_file(file_path, saved) and on_close(). Without on_message, text waits for receive()
+        self.on_message = on_message
+        self.on_progress = on_progress
+        self.on_file = on_file
+        self.on_close = on_close
+        self.progress_interval = progress_interval
+        self.messages = asyncio.Queue()
+
+        self.loop = None
+        # Resolved to True once the server welcomed us, False if it closed first
+        self.joined = None
+        self.reader = None
+        self.writer = None
+        self.task = None
+        # Parallel downloads run beside the connection, kept here until they finish
+        self.downloads = set()
+
+        # Files requested and not yet arrived as [file_name, parallel], oldest first. The
+        # server names each file in the info sent before it, legacy ones send files in order
+        self.requested = collections.deque()
+        # Size, range, hash and name of the file being downloaded, if the server sent them
+        self.file_info = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """Function to open a connection to the server and agree on framing, returning its streams"""
+        reader, writer = await asyncio.open_connection(*self.address, limit=READ_CHUNK)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # Each message is written whole, so Nagle would only delay the next one
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.version == LEGACY:
+            return reader, writer
+
+        writer.write(HELLO + bytes([self.version]))
+        try:
+            header = await reader.readexactly(HEADERSIZE)
+            message_type, _, length = decode_header(header, BINARY)
+            body = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ValueError):
+            message_type, body = None, b''
+        if message_type != HELLO_MSG or not body:
+            writer.close()
+            raise ConnectionError('Binary framing refused')
+
+        self.version = body[0]
+        if self.version >= COMPRESSED:
+            # Tell the server which codecs we can decode, it compresses with one of them
+            names = ' '.join(CODECS).encode(ENCODING)
+            writer.write(encode_header(CODECS_MSG, len(names), self.version) + names)
+            self.codec = choose_codec(str(body[1:], ENCODING).split())
+        return reader, writer
+
+    async def connect(self):
+        """Function to connect, join the chat under the username and start receiving.
+        Returns once the server has joined us, so anything sent after is seen by everyone"""
+        self.loop = asyncio.get_running_loop()
+        self.joined = self.loop.create_future()
+        self.reader, self.writer = await self.open()
+        await self.send(self.username)
+        self.task = asyncio.create_task(self.listen())
+        if not await self.joined:
+            # The server's reason, such as the name being taken, went to on_message
+            raise RuntimeError(f'Could not join the chat as {self.username}')
+
+    async def close(self):
+        """Function to close the connection and wait until receiving has stopped"""
+        if self.writer is None:
+            return
+        for task in list(self.downloads):
+            task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        await self.wait()
+
+    async def wait(self):
+        """Function to wait until the connection closes"""
+        if self.task is not None:
+            await self.task
+
+    def encode_message(self, message):
+        """Function to encode a message with its header"""
+        body = message.encode(ENCODING)
+        flags = 0
+        if self.codec is not None and len(body) >= COMPRESS_MIN_SIZE:
+            compressed = self.codec.compress(body)
+            if len(compressed) < len(body):
+                body, flags = compressed, self.codec.flag
+        return encode_header(TEXT_MSG, len(body), self.version, flags, typed=False) + body
+
+    async def send(self, message):
+        """Function to send a message or command, as it would be typed"""
+        self.writer.write(self.encode_message(message))
+        await self.writer.drain()
+
+    async def send_ping(self):
+        """Function to answer the server's ping, showing the connection is still alive"""
+        self.writer.write(encode_header(PING_MSG, 0, self.version))
+        await self.writer.drain()
+
+    async def receive(self):
+        """Function to wait for the next text message, None once the connection closed.
+        Messages only wait here when there is no on_message callback"""
+        text = await self.messages.get()
+        if text is None:
+            # Leave the end marked for any later call
+            self.messages.put_nowait(None)
+        return text
+
+    async def leave(self):
+        """Function to leave the chat, the server then closes the connection"""
+        await self.send('/leave')
+        await self.wait()
+
+    def saved(self, file_name):
+        """Function to return the bytes of a file already in the folder, where a download resumes"""
+        file_path = os.path.join(self.folder_name, file_name)
+        return os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+
+    async def download(self, file_name, start=None, end=None):
+        """Function to request a file, resuming after any partial copy in the folder, or only
+        the bytes from start to end. The outcome is passed to on_file once the file arrived"""
+        if self.version == LEGACY:
+            # Servers from before this framing only take the name, and send the whole file
+            if start is not None:
+                self.dispatch('[CLIENT]: Byte ranges need a server with binary framing')
+                return
+            self.requested.append([file_name, False])
+            await self.send(f'/download {file_name}')
+            return
+
+        if start is not None:
+            self.requested.append([file_name, False])
+            await self.send(f'/download {file_name} {start}' + ('' if end is None else f' {end}'))
+            return
+
+        offset = self.saved(file_name)
+        # Several connections first ask for an empty range, just to learn the file size
+        parallel = self.connections > 1
+        self.requested.append([file_name, parallel])
+        empty = f' {offset}' if parallel else ''
+        await self.send(f'/download {file_name} {offset}{empty}')
+
+    def take_request(self, file_name=None):
+        """Function to take the request a file answers as (file_name, parallel),
+        the oldest one when the server did not name the file"""
+        for index, (requested, parallel) in enumerate(self.requested):
+            if file_name is None or requested == file_name:
+                del self.requested[index]
+                return requested, parallel
+        # Not asked for, so keep it under the name given
+        return file_name or 'download', False
+
+    def dispatch(self, text):
+        """Function to pass a text message to on_message, or queue it for receive()"""
+        if not self.joined.done() and text.startswith(f'[SERVER]: {self.username} just joined'):
+            self.joined.set_result(True)
+        if self.on_message is not None:
+            self.on_message(text)
+        else:
+            self.messages.put_nowait(text)
+
+    async def read_header(self, reader):
+        """Function to wait for a whole header and return (type, flags, length), None if closed"""
+        try:
+            header = await reader.readexactly(HEADERSIZE)
+        except asyncio.IncompleteReadError:
+            return None
+        return decode_header(header, self.version)
+
+    async def read_message(self, length, flags=0):
+        """Function to receive a whole text message"""
+        message = await self.reader.readexactly(length)
+        if flags:
+            try:
+                message = decompress(flags, message)
+            except ValueError:
+                return '[CLIENT]: Could not decompress a message'
+        # Decode once the whole message is in, so characters split across reads survive
+        return str(message, ENCODING, errors='replace')
+
+    async def listen(self):
+        """Function to handle everything the server sends until the connection closes"""
+        try:
+            while (header := await self.read_header(self.reader)) is not None:
+                message_type, flags, length = header
+                if message_type == PING_MSG:
+                    await self.reader.readexactly(length)
+                    await self.send_ping()
+                elif message_type == FILE_INFO_MSG:
+                    self.file_info = (await self.read_message(length, flags)).split(' ', 5)
+                elif message_type == FILE_MSG:
+                    await self.receive_file(length, flags)
+                else:
+                    text = await self.read_message(length, flags)
+                    # Legacy servers answer downloads in order, a missing file included
+                    if (self.version == LEGACY and self.requested and
+                            text == 'File requested does not exist'):
+                        self.requested.popleft()
+                    self.dispatch(text)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.close()
+            if not self.joined.done():
+                self.joined.set_result(False)
+            if self.on_message is None:
+                self.messages.put_nowait(None)
+            if self.on_close is not None:
+                self.on_close()
+
+    async def receive_file(self, length, flags):
+        """Function to receive a file the server sent, or start fetching it in parallel"""
+        info, self.file_info = self.file_info, None
+        file_name, parallel = self.take_request(info[5] if info and len(info) > 5 else None)
+        file_path = os.path.join(self.folder_name, file_name)
+        if parallel and info:
+            # That was an empty range asking for the size, now fetch the rest. It runs
+            # beside this connection, so chat and pings keep flowing meanwhile
+            task = asyncio.create_task(self.get_file_parallel(file_path, file_name, info))
+            self.downloads.add(task)
+            task.add_done_callback(self.downloads.discard)
+            return
+
+        start = int(info[1]) if info else 0
+        saved = await self.get_file(length, file_path, start, flags)
+        if saved and info:
+            saved = await asyncio.to_thread(self.check_file, file_path, file_name, info)
+        self.finish(file_path, saved)
+
+    def finish(self, file_path, saved):
+        """Function to report where a download was saved"""
+        self.dispatch(f'File saved at: {file_path}')
+        if self.on_file is not None:
+            self.on_file(file_path, saved)
+
+    async def get_file(self, length, file_path, start=0, flags=0):
+        """Function to receive a file body and write it to the folder from start.
+        Returns True once all of it arrived"""
+        # The folder is only made once there is something to save in it
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write into the existing partial file when resuming
+        mode = 'r+b' if start and os.path.exists(file_path) else 'wb'
+        progress = Progress(length, self.on_progress, self.progress_interval)
+        remaining = length
+        # Compressed files are decompressed as they arrive, so a broken
+        # download still leaves a plain prefix that can be resumed
+        decompressor = make_decompressor(flags)
+        try:
+            with open(file_path, mode, buffering=WRITE_BUFFER) as file:
+                file.seek(start)
+                while remaining > 0:
+                    # Take whatever has arrived, the stream buffers up to READ_CHUNK
+                    message = await self.reader.read(min(remaining, READ_CHUNK))
+                    if not message:
+                        self.dispatch(' Something went wrong! Type the same /download to resume')
+                        return False
+                    remaining -= len(message)
+                    file.write(decompressor.decompress(message) if decompressor else message)
+                    progress.update(length - remaining)
+                if hasattr(decompressor, 'flush'):
+                    file.write(decompressor.flush())
+        except CODEC_ERRORS:
+            self.dispatch(' Received a corrupt file! Type the same /download to resume')
+            # Skip the rest of the frame so the next message starts at a header
+            while remaining > 0 and (message := await self.reader.read(min(remaining, READ_CHUNK))):
+                remaining -= len(message)
+            return False
+        progress.update(length)
+        self.dispatch(' Success!')
+        return True
+
+    async def get_file_parallel(self, file_path, file_name, info):
+        """Function to download the rest of a file over several connections at once"""
+        size, start = int(info[0]), int(info[1])
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Preallocate the file so every connection writes its range in place
+        with open(file_path, 'r+b' if os.path.exists(file_path) else 'wb') as file:
+            file.truncate(size)
+
+        # Split the missing bytes into one contiguous range per connection
+        step = max(1, -(-(size - start) // self.connections))
+        ranges = [(begin, min(begin + step, size)) for begin in range(start, size, step)]
+        received = [0] * len(ranges)
+        progress = Progress(size - start, self.on_progress, self.progress_interval)
+        await asyncio.gather(*(self.fetch_range(file_path, file_name, begin, end, received,
+                                                index, progress)
+                               for index, (begin, end) in enumerate(ranges)))
+
+        # Keep only the bytes received without gaps so the download can be resumed
+        complete = start
+        for (begin, end), count in zip(ranges, received):
+            complete += count
+            if begin + count < end:
+                break
+        saved = complete == size
+        if saved:
+            progress.update(size - start)
+            self.dispatch(' Success!')
+            saved = await asyncio.to_thread(self.check_file, file_path, file_name, info)
+        else:
+            with open(file_path, 'r+b') as file:
+                file.truncate(complete)
+            self.dispatch(' Something went wrong! Type the same /download to resume')
+        self.finish(file_path, saved)
+
+    async def fetch_range(self, file_path, file_name, begin, end, received, index, progress):
+        """Function to download one byte range of a file over its own connection"""
+        writer = None
+        try:
+            reader, writer = await self.open()
+            writer.write(self.encode_message(f'/fetch {self.username} {file_name} {begin} {end}'))
+
+            # The range is preceded by the file's size and hash, already known here
+            header = await self.read_header(reader)
+            if header is None or header[0] != FILE_INFO_MSG:
+                return
+            await reader.readexactly(header[2])
+            header = await self.read_header(reader)
+            if header is None or header[0] != FILE_MSG:
+                return
+
+            with open(file_path, 'r+b', buffering=WRITE_BUFFER) as file:
+                file.seek(begin)
+                remaining = header[2]
+                while remaining > 0:
+                    message = await reader.read(min(remaining, READ_CHUNK))
+                    if not message:
+                        return
+                    file.write(message)
+                    remaining -= len(message)
+                    received[index] += len(message)
+                    progress.update(sum(received))
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            return
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def check_file(self, file_path, file_name, info):
+        """Function to compare a finished download against the hash sent by the server.
+        Runs off the event loop, as hashing a large file takes a while"""
+        size, _, _, algorithm, digest = info[:5]
+        size = int(size)
+        saved = os.path.getsize(file_path)
+        if saved < size:
+            self.report(f'Saved {saved} of {size} bytes. Type /download {file_name} to resume')
+            return False
+
+        with open(file_path, 'r+b') as file:
+            # Drop anything left over from an older, longer version of the file
+            file.truncate(size)
+            matches = file_digest(file, algorithm) == digest
+        if matches:
+            self.report('Checksum verified!')
+        else:
+            os.unlink(file_path)
+            self.report('Checksum mismatch, the file has been deleted. Please download it again')
+        return matches
+
+    def report(self, text):
+        """Function to dispatch a message from a worker thread on the event loop"""
+        self.loop.call_soon_threadsafe(self.dispatch, text)
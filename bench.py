@@ -0,0 +1,482 @@
+"""Module providing benchmarks for the server and client networking code"""
+import socket
+import threading
+import subprocess
+import tempfile
+import argparse
+import logging
+import random
+import json
+import time
+import sys
+import os
+from protocol import (ENCODING, BINARY, FILE_MSG, TEXT_MSG, FrameReader,
+                      encode_header, send_hello, decompress)
+
+# Where the load benchmark finds the server when it spawns one
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+SCENARIOS = ('broadcast', 'whisper', 'churn', 'download', 'flood')
+
+def naive_get_message(sock, message_length):
+    """Function to receive a message the way the original server did, for comparison"""
+    full_message = ''
+    while message_length:
+        message = sock.recv(min(message_length, 8192)).decode(ENCODING)
+        message_length -= len(message)
+        full_message += message
+    return full_message
+
+def time_receive(size, receive, repeat):
+    """Function to time receiving a message of size bytes over a local socket pair"""
+    body = b'x' * size
+    frame = encode_header('1', size, BINARY) + body
+    best = float('inf')
+    for _ in range(repeat):
+        reader_sock, writer_sock = socket.socketpair()
+        writer = threading.Thread(target=writer_sock.sendall, args=(frame,))
+        started = time.perf_counter()
+        writer.start()
+        receive(reader_sock, size)
+        best = min(best, time.perf_counter() - started)
+        writer.join()
+        reader_sock.close()
+        writer_sock.close()
+    return best
+
+def bench_recv(args):
+    """Function to show how receiving one message scales with its size"""
+    def buffered(sock, size):
+        reader = FrameReader(sock, BINARY)
+        return str(reader.read()[2], ENCODING)
+
+    def naive(sock, size):
+        sock.recv(10)
+        return naive_get_message(sock, size)
+
+    results = []
+    size = args.min_size
+    while size <= args.max_size:
+        for name, receive in (('buffered', buffered), ('naive', naive)):
+            seconds = time_receive(size, receive, args.repeat)
+            results.append({'reader': name, 'bytes': size, 'seconds': seconds,
+                            'ns_per_byte': seconds * 1e9 / size})
+        size *= 4
+    return results
+
+def percentile(values, fraction):
+    """Function to return the value below which a fraction of the sorted values fall"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def process_usage(pid):
+    """Function to return the resident memory in bytes and CPU seconds of a process,
+    (None, None) where /proc is not available"""
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as status:
+            rss = next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+        with open(f'/proc/{pid}/stat', encoding='ascii') as stat:
+            # The command name may contain spaces, so count fields from after it
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return rss, (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, StopIteration, ValueError):
+        return None, None
+
+class BenchServer:
+    """Class representing a server started on localhost for one benchmark run"""
+    def __init__(self, engine, in_process=False, args=()):
+        # The server keeps its download folder, history and log in its working directory
+        self.folder = tempfile.TemporaryDirectory(prefix='chat-bench-')
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+
+        # Read the options the way the server does, to find its download folder
+        import server # pylint: disable=import-outside-toplevel
+        options = server.make_parser().parse_args([str(self.port), '--engine', engine, *args])
+        self.download = os.path.join(self.folder.name, options.download_folder)
+
+        self.process = self.instance = self.thread = None
+        if in_process:
+            # Memory and CPU then include the load generator itself
+            if options.workers > 1:
+                raise RuntimeError('--workers needs the server in a process of its own')
+            # Paths are made absolute, as this process keeps its own working directory
+            server_options = server.make_options(options)
+            for key in ('download_folder', 'history_folder', 'stats_file'):
+                if server_options[key]:
+                    server_options[key] = os.path.join(self.folder.name, server_options[key])
+            self.instance = server.ENGINES[options.engine](**server_options)
+            self.thread = threading.Thread(target=self.instance.run)
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+        else:
+            self.process = subprocess.Popen([sys.executable, SERVER, str(self.port), # pylint: disable=consider-using-with
+                                             '--engine', engine, *args],
+                                            cwd=self.folder.name, stdout=subprocess.DEVNULL)
+            self.pid = self.process.pid
+        self.wait_ready()
+
+        # Sample memory in the background so the peak of each run is caught
+        self.peak_rss = 0
+        self.sampling = True
+        self.sampler = threading.Thread(target=self.sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def wait_ready(self, timeout=10):
+        """Function to wait until the server accepts connections"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError(f'Server did not start on port {self.port}')
+
+    def sample(self):
+        """Function to track the largest resident memory seen while the run lasts"""
+        while self.sampling:
+            rss = process_usage(self.pid)[0]
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss, rss)
+            time.sleep(0.05)
+
+    def writes(self):
+        """Function to return the server's socket writes and messages sent so far,
+        asked through /stats like an operator would"""
+        client = LoadClient(self.port, 'bench_stats')
+        try:
+            client.send('/stats')
+            while (text := client.read_text()) is not None:
+                if text.startswith('[SERVER]: {'):
+                    counters = json.loads(text.removeprefix('[SERVER]: '))['counters']
+                    return counters.get('writes', 0), counters.get('messages_out', 0)
+            return None
+        finally:
+            client.close()
+
+    def stop(self):
+        """Function to stop the server and remove its files"""
+        self.sampling = False
+        self.sampler.join()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.instance is not None:
+            self.instance.close()
+            self.thread.join()
+        self.folder.cleanup()
+
+class LoadClient:
+    """Class representing a synthetic client speaking the real protocol"""
+    def __init__(self, port, username):
+        self.username = username
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.version, _ = send_hello(self.sock)
+        self.reader = FrameReader(self.sock, self.version)
+        self.send(username)
+        # Wait for our own welcome, so everyone joined before the load starts
+        while (text := self.read_text()) is not None:
+            if text.startswith(f'[SERVER]: {username} just joined'):
+                break
+            if text == '[SERVER]: Username taken':
+                raise RuntimeError(f'Username {username} taken')
+
+    def send(self, message):
+        """Function to send a text message"""
+        body = message.encode(ENCODING)
+        self.sock.sendall(encode_header(TEXT_MSG, len(body), self.version) + body)
+
+    def read_text(self):
+        """Function to block until a text message arrives, None once the connection closed"""
+        while (frame := self.read()) is not None:
+            if frame[0] == TEXT_MSG:
+                return frame[1]
+        return None
+
+    def read(self):
+        """Function to block until a frame arrives and return (type, text), None if closed.
+        File bodies are skipped rather than decoded"""
+        try:
+            header = self.reader.read_header()
+            if header is None:
+                return None
+            message_type, flags, length = header
+            if message_type == FILE_MSG:
+                while length:
+                    chunk = self.reader.read_some(length)
+                    if not chunk:
+                        return None
+                    length -= len(chunk)
+                return message_type, ''
+            body = self.reader.read_body(length)
+        except OSError:
+            return None
+        if body is None:
+            return None
+        if flags:
+            body = decompress(flags, body)
+        return message_type, str(body, ENCODING, errors='replace')
+
+    def listen(self, latencies):
+        """Function to record how long each timestamped message took to arrive"""
+        while (text := self.read_text()) is not None:
+            # Chat arrives as '[sender]: <sent_ns> <padding>'
+            _, separator, payload = text.partition(']: ')
+            stamp = payload.split(' ', 1)[0]
+            if separator and stamp.isdigit():
+                latencies.append(time.perf_counter_ns() - int(stamp))
+
+    def close(self):
+        """Function to leave the chat and close the connection"""
+        try:
+            self.send('/leave')
+        except OSError:
+            pass
+        self.sock.close()
+
+def join_clients(port, count, prefix):
+    """Function to join count clients, each listening for timestamped messages"""
+    latencies = []
+    clients = [LoadClient(port, f'{prefix}{index}') for index in range(count)]
+    for client in clients:
+        thread = threading.Thread(target=client.listen, args=(latencies,))
+        thread.daemon = True
+        thread.start()
+    return clients, latencies
+
+def wait_for(latencies, expected, timeout):
+    """Function to wait until expected messages arrived, or nothing arrived for timeout seconds"""
+    count, idle_since = len(latencies), time.monotonic()
+    while len(latencies) < expected and time.monotonic() - idle_since < timeout:
+        time.sleep(0.01)
+        if len(latencies) != count:
+            count, idle_since = len(latencies), time.monotonic()
+
+def run_senders(clients, target):
+    """Function to run target(client) from every client at once, returning the seconds taken"""
+    threads = [threading.Thread(target=target, args=(client,)) for client in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+def load_broadcast(port, args):
+    """Function to flood the chat from several senders, timing the fan-out to everyone else"""
+    clients, latencies = join_clients(port, args.clients, 'user')
+    padding = 'x' * args.message_size
+
+    def flood(client):
+        for _ in range(args.messages):
+            client.send(f'{time.perf_counter_ns()} {padding}')
+
+    started = time.perf_counter()
+    run_senders(clients[:args.senders], flood)
+    expected = min(args.senders, len(clients)) * args.messages * (len(clients) - 1)
+    wait_for(latencies, expected, args.timeout)
+    seconds = time.perf_counter() - started
+    for client in clients:
+        client.close()
+    return latencies, expected, seconds, len(latencies) * args.message_size
+
+def load_whisper(port, args):
+    """Function to send whispers between random pairs of clients"""
+    clients, latencies = join_clients(port, max(args.clients, 3), 'user')
+    padding = 'x' * args.message_size
+
+    def whisper(client):
+        others = [other.username for other in clients if other is not client]
+        for _ in range(args.messages):
+            client.send(f'/whisper {random.choice(others)} {time.perf_counter_ns()} {padding}')
+
+    started = time.perf_counter()
+    run_senders(clients[:args.senders], whisper)
+    expected = min(args.senders, len(clients)) * args.messages
+    wait_for(latencies, expected, args.timeout)
+    seconds = time.perf_counter() - started
+    for client in clients:
+        client.close()
+    return latencies, expected, seconds, len(latencies) * args.message_size
+
+def load_churn(port, args):
+    """Function to join and leave over and over while others watch, timing each join"""
+    watchers, _ = join_clients(port, args.clients, 'watcher')
+    latencies = []
+
+    def churn(index):
+        for cycle in range(args.messages):
+            started = time.perf_counter_ns()
+            client = LoadClient(port, f'churn{index}_{cycle}')
+            latencies.append(time.perf_counter_ns() - started)
+            client.close()
+
+    seconds = run_senders(range(args.senders), churn)
+    for client in watchers:
+        client.close()
+    return latencies, args.senders * args.messages, seconds, 0
+
+def load_flood(port, args):
+    """Function to flood the chat from several senders while two others chat at a steady
+    pace, timing only the steady messages"""
+    clients, latencies = join_clients(port, args.clients, 'user')
+    flooders = clients[:args.senders]
+    steady = clients[args.senders:args.senders + 2]
+    padding = 'x' * args.message_size
+    flooding = threading.Event()
+    flooding.set()
+
+    def flood(client):
+        # Untimed messages, so only the steady ones are measured
+        try:
+            while flooding.is_set():
+                client.send(f'flood {padding}')
+        except OSError:
+            pass
+
+    def chat(client):
+        for _ in range(args.messages):
+            client.send(f'{time.perf_counter_ns()} {padding}')
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=flood, args=(client,)) for client in flooders]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    started = time.perf_counter()
+    run_senders(steady, chat)
+    expected = len(steady) * args.messages * (len(clients) - 1)
+    wait_for(latencies, expected, args.timeout)
+    seconds = time.perf_counter() - started
+    flooding.clear()
+    for client in clients:
+        client.close()
+    return latencies, expected, seconds, len(latencies) * args.message_size
+
+def load_download(port, args, folder):
+    """Function to download files of mixed sizes from several clients at once"""
+    names = []
+    for size in args.file_sizes:
+        names.append(f'bench_{size}.bin')
+        with open(os.path.join(folder, names[-1]), 'wb') as file:
+            file.write(os.urandom(size))
+    clients = [LoadClient(port, f'user{index}') for index in range(args.senders)]
+    latencies = []
+
+    def download(client):
+        # Give up on the rest once nothing arrived for the timeout
+        client.sock.settimeout(args.timeout)
+        for name in random.sample(names, len(names)):
+            started = time.perf_counter_ns()
+            client.send(f'/download {name} 0')
+            while (frame := client.read()) is not None and frame[0] != FILE_MSG:
+                pass
+            if frame is None:
+                return
+            latencies.append(time.perf_counter_ns() - started)
+
+    seconds = run_senders(clients, download)
+    for client in clients:
+        client.close()
+    received = len(latencies) // len(names) * sum(args.file_sizes)
+    return latencies, len(clients) * len(names), seconds, received
+
+def bench_load(args):
+    """Function to measure what each engine sustains under synthetic chat traffic"""
+    scenarios = SCENARIOS if 'all' in args.scenario else args.scenario
+    results = []
+    for engine in args.engine:
+        for scenario in scenarios:
+            server = BenchServer(engine, args.in_process, args.server_args)
+            try:
+                _, cpu_before = process_usage(server.pid)
+                writes_before = server.writes()
+                if scenario == 'download':
+                    run = load_download(server.port, args, server.download)
+                else:
+                    run = globals()[f'load_{scenario}'](server.port, args)
+                _, cpu_after = process_usage(server.pid)
+                writes_after = server.writes()
+            finally:
+                server.stop()
+            latencies, expected, seconds, payload = run
+            latencies.sort()
+            # Fewer system calls per message means writes are being coalesced
+            writes, messages = (None, None) if None in (writes_before, writes_after) else (
+                after - before for before, after in zip(writes_before, writes_after))
+            results.append({
+                'engine': engine,
+                'scenario': scenario,
+                'clients': args.clients,
+                'expected': expected,
+                'received': len(latencies),
+                'seconds': seconds,
+                'per_second': len(latencies) / seconds,
+                'mb_per_second': payload / seconds / 1e6,
+                'p50_ms': percentile(latencies, 0.5) / 1e6 if latencies else None,
+                'p99_ms': percentile(latencies, 0.99) / 1e6 if latencies else None,
+                'peak_rss_mb': server.peak_rss / 1e6,
+                'cpu_seconds': None if cpu_before is None else cpu_after - cpu_before,
+                'writes_per_msg': writes / messages if messages else None,
+            })
+    return results
+
+def show(results, as_json, file=None):
+    """Function to print results as a table, or as JSON lines for tracking regressions"""
+    file = file or sys.stdout
+    if as_json:
+        for result in results:
+            print(json.dumps(result), file=file)
+        return
+    keys = list(results[0])
+    print(' '.join(f'{key:>14}' for key in keys), file=file)
+    for result in results:
+        print(' '.join(f'{value:>14.6g}' if isinstance(value, float) else f'{value!s:>14}'
+                       for value in result.values()), file=file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the chat server and client')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per result')
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    recv_parser = benchmarks.add_parser('recv', help='time receiving one message of growing sizes')
+    recv_parser.add_argument('--min-size', type=int, default=1 << 10)
+    recv_parser.add_argument('--max-size', type=int, default=1 << 26)
+    recv_parser.add_argument('--repeat', type=int, default=3)
+    recv_parser.set_defaults(run=bench_recv)
+
+    load_parser = benchmarks.add_parser('load', help='drive a local server with synthetic clients')
+    load_parser.add_argument('--engine', nargs='+', choices=('thread', 'event'),
+                             default=['thread', 'event'])
+    load_parser.add_argument('--scenario', nargs='+', choices=('all',) + SCENARIOS,
+                             default=['all'])
+    load_parser.add_argument('--clients', type=int, default=50,
+                             help='clients connected during each run')
+    load_parser.add_argument('--senders', type=int, default=5,
+                             help='clients sending, joining or downloading at once')
+    load_parser.add_argument('--messages', type=int, default=200,
+                             help='messages, whispers or join cycles per sender')
+    load_parser.add_argument('--message-size', type=int, default=64)
+    load_parser.add_argument('--file-sizes', type=int, nargs='+',
+                             default=[1 << 10, 1 << 16, 1 << 20, 1 << 24])
+    load_parser.add_argument('--timeout', type=float, default=10,
+                             help='seconds without a delivery before giving up on the rest')
+    load_parser.add_argument('--in-process', action='store_true',
+                             help='run the server on a thread of this process instead of its own')
+    load_parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                             help='options passed on to server.py, such as --overflow disconnect')
+    load_parser.set_defaults(run=bench_load)
+
+    arguments = parser.parse_args()
+    output = sys.stdout
+    if getattr(arguments, 'in_process', False):
+        # Keep the server's own prints and log out of the results
+        sys.stdout = open(os.devnull, 'w', encoding=ENCODING) # pylint: disable=consider-using-with
+        logging.getLogger().addHandler(logging.NullHandler())
+    show(arguments.run(arguments), arguments.json, output)
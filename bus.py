@@ -0,0 +1,122 @@
+"""Module providing the message bus between the worker processes of one server"""
+import threading
+import queue
+import json
+from protocol import ENCODING, TEXT_MSG, BINARY, Frame, FrameReader, send_frame
+
+def encode(message):
+    """Function to frame a bus message, a dictionary sent as JSON"""
+    return Frame(TEXT_MSG, json.dumps(message).encode(ENCODING))
+
+class Bus:
+    """Class representing a worker's connection to the hub"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader(sock, BINARY)
+        # Handler and writer threads may all publish at once
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        """Function to send a message to the hub"""
+        frame = encode(message)
+        with self.lock:
+            send_frame(self.sock, frame, BINARY)
+
+    def receive(self):
+        """Function to block until the next message from the hub, None once it is gone"""
+        try:
+            frame = self.reader.read()
+        except OSError:
+            return None
+        return None if frame is None else json.loads(str(frame[2], ENCODING))
+
+    def pending(self):
+        """Function to receive what the hub has sent so far, for event loops.
+        Returns the messages, None once the hub is gone"""
+        try:
+            if not self.reader.fill():
+                return None
+        except OSError:
+            return None
+        return [json.loads(str(frame[2], ENCODING)) for frame in self.reader.frames()]
+
+class Hub:
+    """Class representing the parent process, relaying between workers and owning the usernames"""
+    def __init__(self):
+        # Outgoing frames of each worker, written by its own thread so a slow
+        # worker never stops the hub reading from the others
+        self.outboxes = []
+        # Setup registry of every joined username in the form username -> worker
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def add_worker(self, sock):
+        """Function to start relaying for a worker connected through sock"""
+        index = len(self.outboxes)
+        self.outboxes.append(queue.SimpleQueue())
+        for target in (self.read, self.write):
+            thread = threading.Thread(target=target, args=(index, sock))
+            thread.daemon = True
+            thread.start()
+
+    def post(self, index, message):
+        """Function to queue a message for one worker"""
+        self.outboxes[index].put(encode(message))
+
+    def post_others(self, index, message):
+        """Function to queue a message for every worker but one, encoding it once"""
+        frame = encode(message)
+        for other, outbox in enumerate(self.outboxes):
+            if other != index:
+                outbox.put(frame)
+
+    def write(self, index, sock):
+        """Function to send a worker everything queued for it"""
+        outbox = self.outboxes[index]
+        while (frame := outbox.get()) is not None:
+            try:
+                send_frame(sock, frame, BINARY)
+            except OSError:
+                return
+
+    def read(self, index, sock):
+        """Function to handle a worker's messages until it exits"""
+        bus = Bus(sock)
+        while (message := bus.receive()) is not None:
+            self.handle(index, message)
+
+        # Free the names of a worker that went away
+        with self.lock:
+            names = [name for name, owner in self.owners.items() if owner == index]
+            for name in names:
+                del self.owners[name]
+        for name in names:
+            self.post_others(index, {'op': 'left', 'name': name})
+        self.outboxes[index].put(None)
+
+    def handle(self, index, message):
+        """Function to act on one message from a worker"""
+        match message.get('op'):
+            case 'claim':
+                # The registry decides, so two workers cannot both accept a name
+                with self.lock:
+                    name = message['name']
+                    taken = name in self.owners
+                    if not taken:
+                        self.owners[name] = index
+                self.post(index, {'op': 'claimed', 'id': message['id'], 'ok': not taken})
+                if not taken:
+                    self.post_others(index, {'op': 'joined', 'name': name})
+            case 'release':
+                with self.lock:
+                    released = self.owners.get(message['name']) == index
+                    if released:
+                        del self.owners[message['name']]
+                if released:
+                    self.post_others(index, {'op': 'left', 'name': message['name']})
+            case 'broadcast':
+                self.post_others(index, message)
+            case 'whisper':
+                owner = self.owners.get(message['to'])
+                if owner is not None:
+                    self.post(owner, message)
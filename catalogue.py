@@ -0,0 +1,99 @@
+"""Module providing an in-memory index of the files offered for download"""
+import threading
+import bisect
+import time
+import os
+from protocol import make_frame
+
+# Files listed in one reply to /download
+PAGE_SIZE = 50
+
+# Most listing pages kept, as prefixes come from users
+MAX_PAGES = 1024
+
+class Catalogue:
+    """Class representing the files of a download folder, rescanned only when it may have changed"""
+    def __init__(self, folder_name, max_age=1.0, page_size=PAGE_SIZE):
+        self.folder_name = folder_name
+        # Files changed in place do not touch the folder's mtime, so rescan at least this often
+        self.max_age = max_age
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        # Sorted names for prefix searches, name -> (size, mtime) and rendered listing
+        # frames in the form (prefix, page) -> frame. Replaced together on any change,
+        # so readers never see a half updated index
+        self.index = ([], {}, {})
+        self.folder_mtime = None
+        self.scanned = 0
+
+    def __len__(self):
+        self.refresh()
+        return len(self.index[0])
+
+    def refresh(self):
+        """Function to rescan the folder if it changed or the last scan is too old"""
+        now = time.monotonic()
+        try:
+            folder_mtime = os.stat(self.folder_name).st_mtime_ns
+        except OSError:
+            folder_mtime = None
+        if folder_mtime == self.folder_mtime and now - self.scanned < self.max_age:
+            return
+
+        with self.lock:
+            # Another thread may have rescanned while we waited
+            if folder_mtime == self.folder_mtime and now - self.scanned < self.max_age:
+                return
+            entries = {}
+            try:
+                for entry in os.scandir(self.folder_name):
+                    # Hidden files cannot be downloaded, so are not listed either
+                    if entry.name[0] != '.' and entry.is_file():
+                        stat = entry.stat()
+                        entries[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+            if entries != self.index[1]:
+                self.index = (sorted(entries), entries, {})
+            self.folder_mtime = folder_mtime
+            self.scanned = now
+
+    def lookup(self, file_name):
+        """Function to return (size, mtime) of a listed file, None if there is no such file"""
+        self.refresh()
+        return self.index[1].get(file_name)
+
+    def matching(self, names, prefix=''):
+        """Function to return the sorted names starting with prefix"""
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    def page(self, prefix='', number=1):
+        """Function to return the listing of one page of the files starting with prefix,
+        encoded once and shared until the folder changes"""
+        self.refresh()
+        names, entries, pages = self.index
+        key = (prefix, number)
+        if key not in pages:
+            if len(pages) >= MAX_PAGES:
+                pages.clear()
+            pages[key] = make_frame(self.render(names, entries, prefix, number))
+        return pages[key]
+
+    def render(self, names, entries, prefix, number):
+        """Function to build the text of a listing page"""
+        names = self.matching(names, prefix)
+        count = max(1, -(-len(names) // self.page_size))
+        number = min(max(number, 1), count)
+        shown = names[(number - 1) * self.page_size:number * self.page_size]
+        matches = f" starting with '{prefix}'" if prefix else ''
+        lines = [f'[SERVER]: The following files are in [download]{matches}\n\ndownload/']
+        lines.extend(f'   |--- {name} ({entries[name][0]} bytes)' for name in shown)
+        if count > 1:
+            lines.append(f'\n[SERVER]: Page {number} of {count}, ' +
+                         'type /download [prefix]* [page] to see more')
+        lines.append('\n[SERVER]: To download a file, type /download [file_name]')
+        return '\n'.join(lines)
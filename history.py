@@ -0,0 +1,240 @@
+"""Module providing an append-only store of chat messages for replaying history"""
+import threading
+import collections
+import bisect
+import struct
+import array
+import mmap
+import time
+import os
+from protocol import ENCODING
+
+# Each record is the text length, the time sent and the channel name length,
+# followed by the channel name and the text
+RECORD = struct.Struct('!IdB')
+
+# First bytes of every segment file, to recognise the format
+MAGIC = b'HST1'
+
+# Newest messages of each channel kept in memory, and most bytes of text they may
+# hold, as a message can be up to the largest a client may send
+RECENT = 200
+RECENT_BYTES = 1 << 20
+
+class History:
+    """Class representing the message log of a server, kept in numbered segment files"""
+    def __init__(self, folder_name='history', segment_bytes=4 << 20, segments=8, recent=RECENT,
+                 recent_bytes=RECENT_BYTES):
+        # Rotations may happen after the working directory changed
+        self.folder_name = os.path.abspath(folder_name)
+        self.segment_bytes = segment_bytes
+        # Most segment files kept, the oldest is removed once a new one would go over
+        self.segments = max(segments, 1)
+        self.recent = recent
+        self.recent_bytes = recent_bytes
+        # Handler threads append while others replay
+        self.lock = threading.Lock()
+
+        # Setup newest messages in the form channel -> deque of (time, text, size),
+        # with the bytes of text each ring holds in the form channel -> size
+        self.rings = {}
+        self.ring_sizes = {}
+        # Setup where every stored message is in the form channel -> array of
+        # segment number << 32 | offset, oldest first
+        self.positions = {}
+        # Setup maps of the segments no longer written, opened the first time they are read
+        self.maps = {}
+
+        os.makedirs(folder_name, exist_ok=True)
+        earlier = sorted(int(name[:-4]) for name in os.listdir(folder_name)
+                         if name.endswith('.log') and name[:-4].isdigit())
+        # Runs stopped before closing leave empty segments, which would push out real history
+        earlier = [number for number in earlier if not self.remove_empty(number)]
+        self.numbers = collections.deque(earlier)
+
+        # Each run writes a segment of its own, so earlier ones never change
+        self.number = earlier[-1] + 1 if earlier else 1
+        self.file = None
+        self.size = 0
+        self.open_segment()
+
+        # Segments of earlier runs are indexed in the background, so startup
+        # does not grow with the history stored
+        thread = threading.Thread(target=self.load, args=(earlier,))
+        thread.daemon = True
+        thread.start()
+
+    def path(self, number):
+        """Function to return the file name of a segment"""
+        return os.path.join(self.folder_name, f'{number:08d}.log')
+
+    def remove_empty(self, number):
+        """Function to remove a segment holding no messages, returning whether it was removed"""
+        try:
+            if os.path.getsize(self.path(number)) > len(MAGIC):
+                return False
+            os.remove(self.path(number))
+        except OSError:
+            return False
+        return True
+
+    def open_segment(self):
+        """Function to start writing a new segment, dropping the oldest ones over the limit"""
+        self.numbers.append(self.number)
+        self.file = open(self.path(self.number), 'w+b', buffering=1 << 16) # pylint: disable=consider-using-with
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+
+        while len(self.numbers) > self.segments:
+            oldest = self.numbers.popleft()
+            view = self.maps.pop(oldest, None)
+            if view is not None:
+                view.close()
+            try:
+                os.remove(self.path(oldest))
+            except OSError:
+                pass
+            self.forget(self.numbers[0] << 32)
+
+    def forget(self, first):
+        """Function to drop the positions of messages stored before position first"""
+        for channel in list(self.positions):
+            positions = self.positions[channel]
+            del positions[:bisect.bisect_left(positions, first)]
+            if not positions:
+                del self.positions[channel]
+
+    def append(self, channel, text):
+        """Function to store a message sent to a channel"""
+        now = time.time()
+        name = channel.encode(ENCODING)
+        body = text.encode(ENCODING)
+        record = RECORD.pack(len(body), now, len(name)) + name + body
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size + len(record) > self.segment_bytes and self.size > len(MAGIC):
+                self.file.close()
+                self.number += 1
+                self.open_segment()
+            self.positions.setdefault(channel, array.array('Q')).append(
+                self.number << 32 | self.size)
+            # Writes are buffered, so a busy channel costs few system calls
+            self.file.write(record)
+            self.size += len(record)
+            self.remember(channel, now, text, len(body))
+
+    def remember(self, channel, when, text, size):
+        """Function to keep a message in its channel's ring, the lock being held. The oldest
+        make way once the ring holds too many messages or too many bytes, so a message
+        too large for the ring is only read back from disk"""
+        ring = self.rings.setdefault(channel, collections.deque())
+        ring.append((when, text, size))
+        total = self.ring_sizes.get(channel, 0) + size
+        while ring and (len(ring) > self.recent or total > self.recent_bytes):
+            total -= ring.popleft()[2]
+        self.ring_sizes[channel] = total
+
+    def last(self, channel, count):
+        """Function to return up to count of the newest messages of a channel as (time, text)"""
+        with self.lock:
+            ring = self.rings.get(channel, ())
+            positions = self.positions.get(channel, ())
+            # The ring holds the newest messages, so only older ones are read from disk
+            if count <= len(ring) or len(positions) <= len(ring):
+                return [(when, text) for when, text, _ in list(ring)[-count:]]
+            return self.read_all(positions[-count:])
+
+    def read_all(self, positions):
+        """Function to read the messages at positions, skipping any that cannot be read"""
+        messages = []
+        for position in positions:
+            try:
+                messages.append(self.read(position))
+            except (OSError, ValueError, struct.error):
+                # The segment was removed or damaged outside the server
+                continue
+        return messages
+
+    def read(self, position):
+        """Function to read the message at a position, the lock being held"""
+        number, offset = position >> 32, position & 0xffffffff
+        if number == self.number:
+            # The segment still being written is read past the write buffer
+            self.file.flush()
+            header = os.pread(self.file.fileno(), RECORD.size, offset)
+            length, when, name_length = RECORD.unpack(header)
+            body = os.pread(self.file.fileno(), length, offset + RECORD.size + name_length)
+            return when, str(body, ENCODING, errors='replace')
+
+        view = self.view(number)
+        length, when, name_length = RECORD.unpack_from(view, offset)
+        start = offset + RECORD.size + name_length
+        return when, str(view[start:start + length], ENCODING, errors='replace')
+
+    def view(self, number):
+        """Function to map a segment no longer written into memory"""
+        if number not in self.maps:
+            with open(self.path(number), 'rb') as file:
+                self.maps[number] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[number]
+
+    def scan(self, number, positions):
+        """Function to add the position of every full record in a segment to positions"""
+        try:
+            with self.lock:
+                view = self.view(number)
+        except (OSError, ValueError):
+            # Missing, empty or unreadable, so there is nothing to replay from it
+            return
+        try:
+            if view[:len(MAGIC)] != MAGIC:
+                return
+            offset = len(MAGIC)
+            while offset + RECORD.size <= len(view):
+                length, _, name_length = RECORD.unpack_from(view, offset)
+                end = offset + RECORD.size + name_length + length
+                # A record cut short when the server stopped ends the segment
+                if end > len(view):
+                    break
+                channel = str(view[offset + RECORD.size:offset + RECORD.size + name_length],
+                              ENCODING, errors='replace')
+                positions.setdefault(channel, array.array('Q')).append(number << 32 | offset)
+                offset = end
+        except ValueError:
+            # A rotation removed the segment while it was scanned
+            return
+
+    def load(self, numbers):
+        """Function to index segments of earlier runs ahead of what this run stored"""
+        positions = {}
+        for number in numbers:
+            self.scan(number, positions)
+
+        with self.lock:
+            if self.file is None:
+                return
+            for channel, older in positions.items():
+                older.extend(self.positions.get(channel, ()))
+                self.positions[channel] = older
+            # Rotations meanwhile may have removed some of the segments scanned
+            self.forget(self.numbers[0] << 32)
+            for channel in positions:
+                if channel in self.positions:
+                    # Refill the ring from the newest messages on disk
+                    self.rings.pop(channel, None)
+                    self.ring_sizes.pop(channel, None)
+                    for when, text in self.read_all(self.positions[channel][-self.recent:]):
+                        self.remember(channel, when, text, len(text.encode(ENCODING)))
+
+    def close(self):
+        """Function to write out what is buffered and release the files"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                # A run that stored nothing leaves no segment behind
+                self.remove_empty(self.number)
+            for view in self.maps.values():
+                view.close()
+            self.maps.clear()
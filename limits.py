@@ -0,0 +1,79 @@
+"""Module providing limits on how many connections clients open and how fast they send"""
+import threading
+import collections
+import time
+
+class TokenBucket:
+    """Class representing a rate limit that allows bursts, refilled continuously"""
+    def __init__(self, rate, burst):
+        # A rate of 0 means no limit
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, amount=1):
+        """Function to spend tokens, going into debt if there are too few.
+        Returns the seconds to wait until the debt is paid off"""
+        if not self.rate:
+            return 0
+        self.refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def delay(self):
+        """Function to return the seconds until the bucket is out of debt"""
+        if not self.rate:
+            return 0
+        self.refill()
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def refill(self):
+        """Function to add the tokens earned since the last update, up to the burst"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class Throttle:
+    """Class representing the limits on the messages and bytes one client sends"""
+    def __init__(self, message_rate=0, message_burst=1, byte_rate=0, byte_burst=1):
+        self.messages = TokenBucket(message_rate, message_burst)
+        self.bytes = TokenBucket(byte_rate, byte_burst)
+
+    def take(self, size):
+        """Function to count a message of size bytes, returning the seconds to wait
+        before reading another one from the client"""
+        return max(self.messages.take(), self.bytes.take(size))
+
+    def delay(self):
+        """Function to return the seconds to wait before reading from the client again"""
+        return max(self.messages.delay(), self.bytes.delay())
+
+class ConnectionLimits:
+    """Class representing caps on open connections, in total and from one address"""
+    def __init__(self, max_connections=0, max_per_address=0):
+        # A cap of 0 means no limit
+        self.max_connections = max_connections
+        self.max_per_address = max_per_address
+        self.lock = threading.Lock()
+        self.total = 0
+        self.addresses = collections.Counter()
+
+    def admit(self, host):
+        """Function to count a new connection from host, False if it would go over a cap"""
+        with self.lock:
+            if self.max_connections and self.total >= self.max_connections:
+                return False
+            if self.max_per_address and self.addresses[host] >= self.max_per_address:
+                return False
+            self.total += 1
+            self.addresses[host] += 1
+            return True
+
+    def release(self, host):
+        """Function to count a connection from host as closed"""
+        with self.lock:
+            self.total -= 1
+            self.addresses[host] -= 1
+            if not self.addresses[host]:
+                del self.addresses[host]
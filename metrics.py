@@ -0,0 +1,104 @@
+"""Module providing cheap counters and histograms for watching a running server"""
+import threading
+import collections
+import time
+from protocol import FILE_MSG, TEXT_MSG, FILE_INFO_MSG, HELLO_MSG, CODECS_MSG, PING_MSG
+
+# Names used for each frame type in counter names
+TYPE_NAMES = {FILE_MSG: 'file', TEXT_MSG: 'text', FILE_INFO_MSG: 'file_info',
+              HELLO_MSG: 'hello', CODECS_MSG: 'codecs', PING_MSG: 'ping',
+              None: 'text'}
+
+class Histogram:
+    """Class representing a distribution of integers in power of two buckets"""
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        """Function to record one value, costing a few integer operations"""
+        self.buckets[min(int(value).bit_length(), 64)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Function to return an upper bound of the value below which a fraction of values fall"""
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(1 << index, self.max)
+        return 0
+
+    def summary(self, scale=1):
+        """Function to summarise the distribution, dividing values by scale"""
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.total / self.count / scale,
+                'p50': self.percentile(0.5) / scale,
+                'p99': self.percentile(0.99) / scale,
+                'max': self.max / scale}
+
+class Metrics:
+    """Class representing the counters and histograms of one server"""
+    def __init__(self):
+        # One lock keeps updates from handler and writer threads consistent
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.started = time.monotonic()
+        # Totals at the previous snapshot taken by each consumer, to turn counters into
+        # rates, so the stats file and /stats do not move each other's baseline
+        self.previous = {}
+
+    def add(self, name, value=1):
+        """Function to increase a counter"""
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        """Function to record a value in a histogram"""
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def received(self, message_type, size):
+        """Function to count a message read from a client"""
+        with self.lock:
+            self.counters['messages_in'] += 1
+            self.counters[f'bytes_in_{TYPE_NAMES.get(message_type, message_type)}'] += size
+
+    def sent(self, frame, elapsed_ns):
+        """Function to count a frame fully written to a client, elapsed_ns after it started"""
+        name = TYPE_NAMES.get(frame.type, frame.type)
+        with self.lock:
+            self.counters['messages_out'] += 1
+            self.counters[f'bytes_out_{name}'] += len(frame)
+            if frame.type == FILE_MSG:
+                self.counters['downloads'] += 1
+                self.histograms['download_ns'].observe(elapsed_ns)
+
+    def snapshot(self, consumer=None):
+        """Function to return the totals, rates per second since the consumer's previous
+        snapshot, and histogram summaries"""
+        now = time.monotonic()
+        with self.lock:
+            counters = self.counters.copy()
+            histograms = {name: histogram.summary(1e6 if name.endswith('_ns') else 1)
+                          for name, histogram in self.histograms.items()}
+            then, before = self.previous.get(consumer, (self.started, collections.Counter()))
+            self.previous[consumer] = (now, counters)
+        elapsed = max(now - then, 1e-9)
+        return {
+            'uptime': now - self.started,
+            'counters': dict(counters),
+            'per_second': {name: (value - before[name]) / elapsed
+                           for name, value in counters.items()},
+            # Durations are reported in milliseconds
+            'histograms': {name.replace('_ns', '_ms'): summary
+                           for name, summary in histograms.items()},
+        }
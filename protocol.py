@@ -0,0 +1,512 @@
+"""Module providing the wire format shared by the server and client"""
+import os
+import socket
+import struct
+import hashlib
+import zlib
+
+# Faster codecs are used when their packages are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+HEADERSIZE = 10
+ENCODING = 'utf-8'
+FILE_MSG = '0'
+TEXT_MSG = '1'
+# Sent before a ranged file in the form '<size> <start> <end> <algorithm> <digest> <file_name>'
+FILE_INFO_MSG = '2'
+
+# Sent by the server to agree on framing, the body is the chosen version as one
+# byte, followed from version 2 by the names of the codecs the server can decode
+HELLO_MSG = '3'
+# Sent once by version 2 clients after the hello, naming the codecs they can decode
+CODECS_MSG = '4'
+# Sent by the server to a version 3 client that has been quiet, which sends one back
+PING_MSG = '5'
+
+# Framing versions. Legacy headers are an ASCII decimal length, prefixed by the
+# type digit from the server. Binary headers pack the type, flags and a 64 bit
+# length in the same ten bytes, in both directions. Version 2 adds compression
+# and version 3 adds pings
+LEGACY = 0
+BINARY = 1
+COMPRESSED = 2
+KEEPALIVE = 3
+VERSION = KEEPALIVE
+BINARY_HEADER = struct.Struct('!BBQ')
+
+# The low bits of the flags name the codec a frame body was compressed with
+CODEC_MASK = 0x0f
+
+# Legacy server headers only have room for 9 digits
+LEGACY_LIMIT = 10 ** (HEADERSIZE - 1)
+
+# Newer clients open with these bytes and their highest framing version.
+# The first byte can never start a legacy header, which is always a digit
+HELLO = b'\x89TCP'
+
+# Hash used to check a finished download
+DIGEST = 'blake2b'
+
+# Scatter-gather writes and zero-copy file sends are not available on every platform (e.g. Windows)
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+HAS_SENDFILE = hasattr(os, 'sendfile')
+
+# Bytes read per call when a file has to be copied through user space
+FILE_CHUNK = 65536
+
+# Starting size of each connection's receive buffer
+RECV_BUFFER = 65536
+
+# Bodies smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+class Codec:
+    """Class representing a compression format for frame bodies"""
+    def __init__(self, flag, name, compress, compressor, decompressor):
+        self.flag = flag
+        self.name = name
+        self.compress = compress
+        # Streaming objects with compress/flush and decompress methods
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+class LZ4Compressor:
+    """Class representing an lz4 frame compressor with the same interface as zlib's"""
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.started = False
+
+    def compress(self, data):
+        """Function to compress a chunk, starting the lz4 frame on the first call"""
+        prefix = b'' if self.started else self.compressor.begin()
+        self.started = True
+        return prefix + self.compressor.compress(data)
+
+    def flush(self):
+        """Function to end the lz4 frame"""
+        prefix = b'' if self.started else self.compressor.begin()
+        self.started = True
+        return prefix + self.compressor.flush()
+
+# Available codecs by name, in order of preference
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = Codec(2, 'zstd', zstandard.ZstdCompressor().compress,
+                           lambda: zstandard.ZstdCompressor().compressobj(),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+if lz4 is not None:
+    CODECS['lz4'] = Codec(3, 'lz4', lz4.frame.compress, LZ4Compressor,
+                          lz4.frame.LZ4FrameDecompressor)
+CODECS['zlib'] = Codec(1, 'zlib', zlib.compress, zlib.compressobj, zlib.decompressobj)
+CODEC_FLAGS = {codec.flag: codec for codec in CODECS.values()}
+
+# Errors raised by the codecs on corrupt input
+CODEC_ERRORS = (zlib.error, RuntimeError) + ((zstandard.ZstdError,) if zstandard else ())
+
+def choose_codec(names):
+    """Function to pick our most preferred codec out of the names the peer can decode"""
+    for name in CODECS:
+        if name in names:
+            return CODECS[name]
+    return None
+
+def make_decompressor(flags):
+    """Function to start streaming decompression of a frame body, None if it is not compressed"""
+    if not flags & CODEC_MASK:
+        return None
+    codec = CODEC_FLAGS.get(flags & CODEC_MASK)
+    if codec is None:
+        raise ValueError(f'Unknown codec in flags {flags}')
+    return codec.decompressor()
+
+def decompress(flags, body, limit=None):
+    """Function to decompress a frame body, stopping once it grows past limit bytes"""
+    decompressor = make_decompressor(flags)
+    chunks = []
+    size = 0
+    try:
+        # Feed small pieces so a tiny body cannot expand into gigabytes before the check
+        for start in range(0, len(body), 4096):
+            chunk = decompressor.decompress(body[start:start + 4096])
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise ValueError(f'Message expands past {limit} bytes')
+            chunks.append(chunk)
+        if hasattr(decompressor, 'flush'):
+            chunks.append(decompressor.flush())
+    except CODEC_ERRORS as error:
+        raise ValueError(f'Corrupt compressed message: {error}') from error
+    return b''.join(chunks)
+
+def encode_header(message_type, length, version=LEGACY, flags=0, typed=True):
+    """Function to build a header, legacy ones from the client carry no type"""
+    if version >= BINARY:
+        return BINARY_HEADER.pack(int(message_type), flags, length)
+    if not typed:
+        return f'{length:<{HEADERSIZE}}'.encode(ENCODING)
+    if length >= LEGACY_LIMIT:
+        raise ValueError(f'{length} bytes do not fit in a legacy header')
+    return f'{message_type}{length:<{HEADERSIZE-1}}'.encode(ENCODING)
+
+def decode_header(header, version=LEGACY, typed=True):
+    """Function to read (type, flags, length) from a header, legacy ones from the client carry no type"""
+    if version is not None and version >= BINARY:
+        message_type, flags, length = BINARY_HEADER.unpack(header)
+        return str(message_type), flags, length
+    header = bytes(header).decode(ENCODING)
+    if not typed:
+        return TEXT_MSG, 0, parse_length(header)
+    return header[0], 0, parse_length(header[1:])
+
+def parse_length(text):
+    """Function to read the length in a legacy header, plain digits padded with spaces.
+    int() alone would also take signs and underscores, and a negative length rewinds the reader"""
+    digits = text.rstrip(' ')
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f'Invalid length {text!r} in header')
+    return int(digits)
+
+class Frame:
+    """Class representing an encoded message, built once and shared by every recipient"""
+    __slots__ = ('type', 'flags', 'body', 'headers', 'variants')
+
+    def __init__(self, message_type, body, flags=0):
+        self.type = message_type
+        self.flags = flags
+        self.body = memoryview(body)
+        # Headers for each framing version, built the first time a recipient needs one
+        self.headers = {}
+        # Compressed copies for each codec, also built once per frame
+        self.variants = {}
+
+    def __len__(self):
+        # Both framing versions use headers of the same size
+        return HEADERSIZE + len(self.body)
+
+    @property
+    def nbytes(self):
+        """Bytes of memory held by the frame"""
+        return len(self)
+
+    def header(self, version):
+        """Function to return the header for a framing version"""
+        if version not in self.headers:
+            self.headers[version] = memoryview(
+                encode_header(self.type, len(self.body), version, self.flags))
+        return self.headers[version]
+
+    def buffers(self, offset=0, version=LEGACY):
+        """Function to return the unsent parts of the frame without copying them"""
+        if offset < HEADERSIZE:
+            return [self.header(version)[offset:], self.body]
+        return [self.body[offset - HEADERSIZE:]]
+
+    def write(self, sock, offset=0, version=LEGACY):
+        """Function to write part of the frame from offset, returning the number of bytes sent"""
+        return send_buffers(sock, self.buffers(offset, version))
+
+    def compressed(self, codec, min_size=COMPRESS_MIN_SIZE):
+        """Function to return the frame compressed with a codec, or itself when that does not help"""
+        if codec is None or self.flags & CODEC_MASK or len(self.body) < min_size:
+            return self
+        if codec.name not in self.variants:
+            body = codec.compress(self.body)
+            # Keep sending the original when the body does not shrink
+            self.variants[codec.name] = (Frame(self.type, body, self.flags | codec.flag)
+                                         if len(body) < len(self.body) else self)
+        return self.variants[codec.name]
+
+    def close(self):
+        """Function to release the frame, buffers need no cleanup"""
+
+class FileFrame:
+    """Class representing a file message whose body is streamed from disk on demand"""
+    __slots__ = ('type', 'flags', 'file', 'start', 'count')
+
+    def __init__(self, file, start, count, message_type=FILE_MSG, flags=0):
+        self.type = message_type
+        self.flags = flags
+        self.file = file
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return HEADERSIZE + self.count
+
+    @property
+    def nbytes(self):
+        """Bytes of memory held by the frame, the body stays on disk"""
+        return HEADERSIZE
+
+    def write(self, sock, offset=0, version=LEGACY):
+        """Function to write part of the frame from offset, returning the number of bytes sent"""
+        if offset < HEADERSIZE:
+            header = encode_header(self.type, self.count, version, self.flags)
+            return sock.send(header[offset:])
+
+        position = self.start + offset - HEADERSIZE
+        remaining = self.count - (offset - HEADERSIZE)
+        if HAS_SENDFILE:
+            # The kernel copies straight from the page cache to the socket
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), position, remaining)
+        else:
+            self.file.seek(position)
+            sent = sock.send(self.file.read(min(remaining, FILE_CHUNK)))
+        if not sent:
+            raise OSError('File was truncated while being sent')
+        return sent
+
+    def compressed(self, codec, min_size=COMPRESS_MIN_SIZE): # pylint: disable=unused-argument
+        """Function to return the frame unchanged, files are compressed ahead of time on disk"""
+        return self
+
+    def close(self):
+        """Function to close the file once it has been sent or discarded"""
+        self.file.close()
+
+def make_frame(message, message_type=None):
+    """Function to frame a text message, bytes or an open binary file for sending from the server"""
+    if isinstance(message, (Frame, FileFrame)):
+        return message
+    if isinstance(message, str):
+        message_type = message_type or TEXT_MSG
+        message = message.encode(ENCODING)
+    elif isinstance(message, (bytes, bytearray, memoryview)):
+        # For binary data, keep the caller's buffer instead of copying it behind the header
+        message_type = message_type or FILE_MSG
+    else:
+        # For open files, stream the content from disk so memory use stays constant
+        return make_file_frame(message)
+
+    return Frame(message_type, message)
+
+def make_file_frame(file, start=0, count=None, flags=0):
+    """Function to frame count bytes of an open binary file from start, to the end by default"""
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - start
+    return FileFrame(file, start, count, flags=flags)
+
+def fits(frame, version):
+    """Function to check a frame's length can be written in a header of the framing version"""
+    return version != LEGACY or len(frame) - HEADERSIZE < LEGACY_LIMIT
+
+def file_digest(file, algorithm=DIGEST):
+    """Function to hash an open binary file from its start without loading it into memory"""
+    digest = hashlib.new(algorithm)
+    file.seek(0)
+    while chunk := file.read(1 << 20):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def send_buffers(sock, buffers):
+    """Function to write buffers in one system call, returning the number of bytes sent"""
+    if HAS_SENDMSG:
+        return sock.sendmsg(buffers)
+    # Without sendmsg, sending only the first buffer is still a valid partial write
+    return sock.send(buffers[0])
+
+def send_frame(sock, frame, version=LEGACY):
+    """Function to write a whole frame to a blocking socket"""
+    offset = 0
+    while offset < len(frame):
+        offset += frame.write(sock, offset, version)
+
+class FrameReader:
+    """Class representing the receive side of a connection, parsing frames out of one reusable buffer"""
+    def __init__(self, sock, version=LEGACY, typed=True, max_size=None):
+        self.sock = sock
+        self.version = version
+        # Legacy headers from the client carry no type
+        self.typed = typed
+        # Largest body accepted, so a bad header cannot claim unbounded memory
+        self.max_size = max_size
+        self.buffer = bytearray(RECV_BUFFER)
+        self.view = memoryview(self.buffer)
+        # Unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def unread(self):
+        """Function to return the bytes received but not yet consumed"""
+        return self.view[self.start:self.end]
+
+    def skip(self, count):
+        """Function to consume bytes without parsing them"""
+        self.start += count
+
+    def reserve(self, size):
+        """Function to make room for size unread bytes, moving or growing the buffer as needed"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.start + size <= len(self.buffer):
+            return
+
+        unread = self.end - self.start
+        if size <= len(self.buffer):
+            # Move the partial message to the front, only its bytes are copied
+            self.buffer[:unread] = self.view[self.start:self.end]
+        else:
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start, self.end = 0, unread
+
+    def release(self):
+        """Function to give back the memory of a large message once it has been consumed"""
+        if self.start == self.end and len(self.buffer) > RECV_BUFFER:
+            self.buffer = bytearray(RECV_BUFFER)
+            self.view = memoryview(self.buffer)
+            self.start = self.end = 0
+
+    def receive(self, view):
+        """Function to receive into a view, waiting out socket timeouts"""
+        while True:
+            try:
+                return self.sock.recv_into(view)
+            except socket.timeout:
+                continue
+
+    def fill(self):
+        """Function to receive into the free end of the buffer, returning 0 once the peer closed"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self.reserve(self.end - self.start + RECV_BUFFER // 2)
+        count = self.receive(self.view[self.end:])
+        self.end += count
+        return count
+
+    def decode(self):
+        """Function to read the header at the start of the unread bytes"""
+        header = decode_header(self.view[self.start:self.start + HEADERSIZE],
+                               self.version, self.typed)
+        if self.max_size is not None and header[2] > self.max_size:
+            raise ValueError(f'Message of {header[2]} bytes is too large')
+        return header
+
+    def next_frame(self):
+        """Function to take one whole frame (type, flags, body) out of the buffer, without blocking.
+        The body is a view that is only valid until the next read"""
+        if self.end - self.start < HEADERSIZE:
+            return None
+        message_type, flags, length = self.decode()
+        total = HEADERSIZE + length
+        if self.end - self.start < total:
+            # Only make room for what fits now, fill() grows the buffer as the rest
+            # arrives, so a header alone cannot claim the memory it declares
+            self.reserve(min(total, len(self.buffer)))
+            return None
+        body = self.view[self.start + HEADERSIZE:self.start + total]
+        self.start += total
+        self.release()
+        return message_type, flags, body
+
+    def frames(self):
+        """Function to yield every whole frame already in the buffer"""
+        while (frame := self.next_frame()) is not None:
+            yield frame
+
+    def read(self):
+        """Function to block until a whole frame arrives, None if the peer closed.
+        The body is a view that is only valid until the next read"""
+        header = self.read_header()
+        if header is None:
+            return None
+        body = self.read_body(header[2])
+        if body is None:
+            return None
+        return header[0], header[1], body
+
+    def read_header(self):
+        """Function to block until a header arrives and return (type, flags, length), None if closed"""
+        while self.end - self.start < HEADERSIZE:
+            self.reserve(HEADERSIZE)
+            if not self.fill():
+                return None
+        header = self.decode()
+        self.start += HEADERSIZE
+        return header
+
+    def read_body(self, length):
+        """Function to block until length bytes arrive, None if the peer closed first.
+        The body is a view that is only valid until the next read"""
+        if length > RECV_BUFFER:
+            # Receive large bodies straight into their own buffer, copying only what was read ahead.
+            # It doubles as bytes arrive, so a header alone cannot claim the memory it declares
+            count = min(length, self.end - self.start)
+            body = bytearray(self.view[self.start:self.start + count])
+            self.start += count
+            while count < length:
+                if count == len(body):
+                    body.extend(bytes(min(length, max(2 * count, RECV_BUFFER)) - count))
+                with memoryview(body) as view:
+                    received = self.receive(view[count:])
+                if not received:
+                    return None
+                count += received
+            return memoryview(body)
+
+        self.reserve(length)
+        while self.end - self.start < length:
+            if not self.fill():
+                return None
+        self.start += length
+        return self.view[self.start - length:self.start]
+
+    def read_some(self, limit):
+        """Function to return up to limit bytes as soon as any arrive, empty if the peer closed.
+        The view is only valid until the next read"""
+        if self.start == self.end and not self.fill():
+            return b''
+        count = min(limit, self.end - self.start)
+        self.start += count
+        return self.view[self.start - count:self.start]
+
+def recv_exact(sock, size):
+    """Function to read exactly size bytes from a blocking socket, empty if it closes first"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return b''
+        received += count
+    return buffer
+
+def send_hello(sock, version=VERSION):
+    """Function to offer binary framing from a new connection.
+    Returns the version agreed and the codecs the server can decode, None if refused"""
+    sock.sendall(HELLO + bytes([version]))
+    header = recv_exact(sock, HEADERSIZE)
+    if not header:
+        return None
+    message_type, _, length = decode_header(header, BINARY)
+    body = recv_exact(sock, length)
+    if message_type != HELLO_MSG or not body:
+        return None
+    version = body[0]
+    if version < COMPRESSED:
+        return version, []
+    # Tell the server which codecs we can decode, it compresses with one of them
+    names = ' '.join(CODECS).encode(ENCODING)
+    sock.sendall(encode_header(CODECS_MSG, len(names), version) + names)
+    return version, str(body[1:], ENCODING).split()
+
+def hello_reply(version):
+    """Function to build the server's reply to a hello, naming its codecs from version 2"""
+    body = bytes([version])
+    if version >= COMPRESSED:
+        body += ' '.join(CODECS).encode(ENCODING)
+    return Frame(HELLO_MSG, body)
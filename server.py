@@ -2,27 +2,310 @@
 import sys
 import socket
 import threading
+import selectors
+import argparse
 import logging
+import logging.handlers
+import queue
+import ipaddress
+import multiprocessing
+import signal
+import json
+import time
 import os
+import re
+import select
 import random
+import collections
+import itertools
+from protocol import (ENCODING, TEXT_MSG, FILE_INFO_MSG, CODECS_MSG, PING_MSG, CODEC_MASK, DIGEST,
+                      COMPRESS_MIN_SIZE, LEGACY, BINARY, KEEPALIVE, VERSION, HELLO, Frame,
+                      FrameReader,
+                      fits, recv_exact, make_frame, make_file_frame, file_digest, send_frame,
+                      send_buffers, hello_reply, choose_codec, decompress)
+from metrics import Metrics
+from catalogue import Catalogue
+from history import History
+from limits import Throttle, ConnectionLimits
+from bus import Bus, Hub
 
-logging.basicConfig(filename='server.log',
-                    filemode='w',
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    level=logging.DEBUG)
+# Largest chat message or command accepted from a client
+MAX_MESSAGE = 16 << 20
 
-HEADERSIZE = 10
-ENCODING = 'utf-8'
-FILE_MSG = '0'
-TEXT_MSG = '1'
+# Largest first message, the username or a data connection's fetch, so clients
+# that have not joined cannot make the server hold much memory for them
+MAX_FIRST_MESSAGE = 1 << 10
+
+# What to do when a client falls behind by more than its send queue allows
+OVERFLOW_POLICIES = ('drop-oldest', 'disconnect')
+
+# Channel every client is in when it joins, where messages keep the original format
+DEFAULT_CHANNEL = 'general'
+
+# Names accepted by /join, with or without a leading #
+CHANNEL_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+# Most frames and bytes gathered into one write, keeping well under the
+# platform's limit on buffers per sendmsg call
+MAX_BATCH_FRAMES = 64
+MAX_BATCH_BYTES = 256 << 10
+
+# Holding back partial packets while a file streams is only possible on Linux
+HAS_CORK = hasattr(socket, 'TCP_CORK')
+
+# Messages replayed by /history without a count, and the most it replays
+HISTORY_DEFAULT = 20
+HISTORY_MAX = 500
+
+# Kernel keepalive probes for peers that vanished without closing, as
+# (option, value) for the options this platform has: seconds idle before
+# probing, seconds between probes and probes lost before giving up
+KEEPALIVE_OPTIONS = tuple((getattr(socket, name), value) for name, value in
+                          (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 5))
+                          if hasattr(socket, name))
+
+# Sent to quiet clients that answer pings, shared by all of them
+PING = make_frame(b'', PING_MSG)
+
+# Hidden file in the download folder keeping hashes and compressed copies across restarts
+INDEX_FILE = '.index.json'
+
+# Files already compressed by their format, not worth compressing again
+INCOMPRESSIBLE = ('.gz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar',
+                  '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.pdf')
+
+class BatchedFileHandler(logging.handlers.RotatingFileHandler):
+    """Class representing a rotating log file only flushed once a batch of records is written"""
+    def flush(self):
+        """Function to leave records in the file buffer until the batch ends"""
+
+    def flush_batch(self):
+        """Function to write the buffered records out to the file"""
+        with self.lock:
+            super().flush()
+
+class BatchingListener(logging.handlers.QueueListener):
+    """Class representing the thread writing queued log records, flushing whenever it catches up"""
+    def dequeue(self, block):
+        """Function to take the next record, flushing the handlers before waiting for more"""
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush_batch()
+            return self.queue.get(block)
+
+def setup_logging(file_name='server.log', level=logging.INFO, max_bytes=10 << 20, backups=3):
+    """Function to log through a queue, so threads handling clients never wait on the disk.
+    Returns the listener writing the file, to be stopped on exit"""
+    handler = BatchedFileHandler(file_name, maxBytes=max_bytes, backupCount=backups,
+                                 encoding=ENCODING, delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    # Start each run in a fresh file, keeping earlier runs as backups
+    if os.path.exists(file_name) and os.path.getsize(file_name):
+        handler.doRollover()
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = BatchingListener(records, handler)
+    listener.start()
+    return listener
+
+def set_tcp_option(sock, option, value):
+    """Function to set a TCP level socket option, ignoring sockets that are not TCP"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError:
+        pass
+
+class SendQueueFull(Exception):
+    """Exception raised when a client overflows its send queue under the disconnect policy"""
+
+class SendQueue:
+    """Class representing a bounded queue of frames waiting for one client"""
+    def __init__(self, max_bytes=1 << 20, max_messages=1000, overflow='drop-oldest',
+                 version=LEGACY, codec=None, compress_min_size=COMPRESS_MIN_SIZE, metrics=None):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.overflow = overflow
+        # Framing version agreed with the client
+        self.version = version
+        # Codec the client can decode, None to send everything uncompressed
+        self.codec = codec
+        self.compress_min_size = compress_min_size
+        self.messages = collections.deque()
+        self.size = 0
+        # Bytes of the oldest message already written, and the oldest messages
+        # handed to a write still in progress, which must not be dropped
+        self.offset = 0
+        self.sending = 0
+        # Whether the socket holds back partial packets while a file streams
+        self.corked = False
+        self.dropped = 0
+        self.closed = False
+        self.ready = threading.Condition()
+        # Counts sent and dropped frames when given, with when the oldest frame started
+        self.metrics = metrics
+        self.started = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message):
+        """Function to queue a message, applying the overflow policy when over the cap"""
+        with self.ready:
+            if self.closed:
+                message.close()
+                return
+            # The compressed copy is made once per frame and shared by every client with this codec
+            message = message.compressed(self.codec, self.compress_min_size)
+            # Only bytes held in memory count towards the cap, so streamed
+            # files do not push out chat. A message is always accepted into
+            # an empty queue, so one large message cannot be refused outright
+            while self.messages and (len(self.messages) >= self.max_messages or
+                                     self.size + message.nbytes > self.max_bytes):
+                if self.overflow == 'disconnect':
+                    message.close()
+                    raise SendQueueFull
+                # Only chat is dropped, never a message already partially on the wire.
+                # A file and its info are kept together, the client cannot do without either
+                first = max(self.sending, 1 if self.offset else 0)
+                index = next((index for index, queued in
+                              enumerate(itertools.islice(self.messages, first, None), first)
+                              if queued.type == TEXT_MSG), None)
+                if index is None:
+                    break
+                self.size -= self.messages[index].nbytes
+                self.messages[index].close()
+                del self.messages[index]
+                self.dropped += 1
+                if self.metrics is not None:
+                    self.metrics.add('dropped')
+            self.messages.append(message)
+            self.size += message.nbytes
+            self.ready.notify()
+
+    def wait(self, window=0):
+        """Function to wait for a message, then up to window seconds for more to
+        write along with it. Returns False once closed"""
+        with self.ready:
+            while not self.messages and not self.closed:
+                self.ready.wait()
+            deadline = time.monotonic() + window
+            while (not self.closed and len(self.messages) < MAX_BATCH_FRAMES and
+                   self.size < MAX_BATCH_BYTES and (remaining := deadline - time.monotonic()) > 0):
+                self.ready.wait(remaining)
+            return not self.closed
+
+    def batch(self):
+        """Function to gather the unsent parts of the oldest frames held in memory,
+        returning the buffers and how many frames they cover"""
+        buffers = []
+        size = 0
+        count = 0
+        offset = self.offset
+        for message in self.messages:
+            if (not isinstance(message, Frame) or count == MAX_BATCH_FRAMES or
+                    size >= MAX_BATCH_BYTES):
+                break
+            parts = message.buffers(offset, self.version)
+            buffers.extend(parts)
+            size += sum(len(part) for part in parts)
+            count += 1
+            offset = 0
+        return buffers, count
+
+    def send(self, sock):
+        """Function to write the oldest messages to a socket in one system call. Frames
+        held in memory are written together, files are streamed on their own"""
+        with self.ready:
+            if not self.messages:
+                return
+            started = time.perf_counter_ns()
+            if not self.offset:
+                self.started = started
+            buffers, count = self.batch()
+            # A file at the head is written on its own and must stay put just the same
+            self.sending = max(count, 1)
+            message = self.messages[0]
+        sent = 0
+        try:
+            if buffers:
+                sent = send_buffers(sock, buffers)
+            else:
+                # Hold back the header until file data follows it, so packets stay full
+                if HAS_CORK and not self.corked:
+                    set_tcp_option(sock, socket.TCP_CORK, 1)
+                    self.corked = True
+                sent = message.write(sock, self.offset, self.version)
+            if self.metrics is not None:
+                self.metrics.add('writes')
+        finally:
+            # Frames written are taken off before others may be dropped again,
+            # so the bytes sent are credited to the frames they came from
+            with self.ready:
+                self.sending = 0
+                # The queue may have been closed while writing
+                while sent and self.messages:
+                    message = self.messages[0]
+                    written = min(sent, len(message) - self.offset)
+                    self.offset += written
+                    sent -= written
+                    if self.offset < len(message):
+                        break
+                    self.messages.popleft()
+                    self.size -= message.nbytes
+                    message.close()
+                    self.offset = 0
+                    if self.metrics is not None:
+                        self.metrics.sent(message, time.perf_counter_ns() - self.started)
+                    self.started = started
+                streaming = self.messages and not isinstance(self.messages[0], Frame)
+        if self.corked and not streaming:
+            # Push out the end of the file now rather than waiting for the cork to time out
+            set_tcp_option(sock, socket.TCP_CORK, 0)
+            self.corked = False
+
+    def close(self):
+        """Function to discard queued messages and wake up the writer"""
+        with self.ready:
+            self.closed = True
+            for message in self.messages:
+                message.close()
+            self.messages.clear()
+            self.size = 0
+            self.ready.notify()
+
+class PendingRange:
+    """Class representing a byte range a client asked for, waiting for its file to be hashed"""
+    def __init__(self, file_name, file_data, span, codec=None):
+        self.file_name = file_name
+        self.file_data = file_data
+        # Size of the file, and start and end of the range
+        self.span = span
+        self.codec = codec
+        self.ready = False
+        self.digest = None
 
 class Server:
     """Class representing a server"""
-    def __init__(self, host='127.0.0.1', port=1234):
+    def __init__(self, host='127.0.0.1', port=1234,
+                 queue_bytes=1 << 20, queue_messages=1000, overflow='drop-oldest',
+                 compression=True, compress_min_size=COMPRESS_MIN_SIZE,
+                 stats_file=None, stats_interval=60, seed=False, bus=None, coalesce_window=0,
+                 history_folder='history', history_segment_bytes=4 << 20, history_segments=8,
+                 handshake_timeout=10, ping_interval=30, idle_timeout=90,
+                 message_rate=50, message_burst=200, byte_rate=1 << 20, byte_burst=MAX_MESSAGE,
+                 max_connections=10000, max_per_address=0, download_folder='download'):
         # Setup server socket
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.settimeout(1)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bus is not None:
+            # Every worker process listens on the port and the kernel spreads connections
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((host, port))
         self.server.listen()
         logging.info('Opened server')
@@ -33,125 +316,613 @@ class Server:
         # Setup mapping back from username to socket
         self.taken_names = {}
 
+        # Setup channel membership in the form channel -> set of sockets, and the
+        # channels of each client in joining order, the last being where it talks
+        self.channels = {}
+        self.memberships = {}
+
+        # Setup link to the other worker processes, with the names joined there
+        # and the callbacks waiting for the hub to answer each username claim
+        self.bus = bus
+        self.remote_names = set()
+        self.claims = {}
+        self.claim_ids = itertools.count(1)
+
+        # Setup caps on open connections, and the time by which each connection
+        # still in its handshake must have joined in the form socket -> deadline
+        self.limits = ConnectionLimits(max_connections, max_per_address)
+        self.handshake_timeout = handshake_timeout
+        self.handshakes = {}
+        # Usernames of clients still joining, so two at once cannot take the same one
+        self.joining = set()
+        self.join_lock = threading.Lock()
+
+        # Setup rate limits of each joined client, and when each last sent
+        # anything and was last pinged in the form socket -> time
+        self.rates = (message_rate, message_burst, byte_rate, byte_burst)
+        self.throttles = {}
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.seen = {}
+        self.pinged = {}
+
+        # Setup outbound message queue for each joined client
+        self.queues = {}
+        self.queue_bytes = queue_bytes
+        self.queue_messages = queue_messages
+        self.overflow = overflow
+        # Seconds a writer waits for more frames to send along with the first
+        self.coalesce_window = coalesce_window
+
+        # Setup cache of file hashes in the form (path, size, mtime) -> digest, the
+        # callbacks waiting for files being hashed in the form (path, size, mtime) -> list
+        # and the ranges each client asked for that wait on a hash, oldest first
+        self.digests = {}
+        self.hashing = {}
+        self.ranges = {}
+        self.hash_lock = threading.Lock()
+
+        # Setup codec chosen by each client that has not joined yet
+        self.codecs = {}
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+
+        # Setup cache of compressed copies in the form (path, codec) -> (size, mtime, copy)
+        # where copy is None for files that do not shrink
+        self.compressed = {}
+        self.compressing = set()
+
         self.running = True
 
-        folder_name = 'download'
-        self.make_folder(folder_name)
+        # Setup log of chat messages replayed by /history, None when not kept
+        self.history = None
+        if history_folder:
+            self.history = History(history_folder, history_segment_bytes, history_segments)
 
-    def delete_folder(self, folder_name):
-        """Function to delete a folder and its contents"""
-        if os.path.exists(folder_name):
-            for entry in os.scandir(folder_name):
-                if entry.is_file():
-                    os.unlink(entry.path)
-                    print(f"Deleted file: {os.path.basename(entry.path)}")
+        # Setup counters and histograms, dumped to a file every interval if asked
+        self.metrics = Metrics()
+        if stats_file:
+            thread = threading.Thread(target=self.dump_stats, args=(stats_file, stats_interval))
+            thread.daemon = True
+            thread.start()
 
-            os.rmdir(folder_name)
-            print(f"Folder '{folder_name}' has been deleted")
+        self.download_folder = download_folder
+        self.make_folder(download_folder, seed)
+        # Setup index of the files offered, so requests do not rescan the folder
+        self.catalogue = Catalogue(download_folder)
 
-    def make_folder(self, folder_name):
-        """Function to initialize a folder"""
-        self.delete_folder(folder_name)
-        os.makedirs(folder_name)
-        logging.debug('Created folder %s', folder_name)
+        # Hashes and compressed copies from earlier runs are loaded in the
+        # background, so startup does not grow with the content stored
+        self.index_path = os.path.join(download_folder, INDEX_FILE)
+        self.index_lock = threading.Lock()
+        thread = threading.Thread(target=self.load_index)
+        thread.daemon = True
+        thread.start()
+
+    def make_folder(self, folder_name, seed=False):
+        """Function to initialize a folder, keeping whatever it already holds"""
+        os.makedirs(folder_name, exist_ok=True)
+        if not seed:
+            return
 
         # Populate folder with random files of size between 128 to 2048 bytes
         num_of_files = 5
         for i in range(num_of_files):
             file_path = os.path.join(folder_name, f'file_{i+1}.bin')
+            if os.path.exists(file_path):
+                continue
             with open(file_path, 'wb') as f:
                 f.write(os.urandom(random.randint(128, 2048)))
-        logging.debug('Created %s random binary files in %s', num_of_files, folder_name)
+        logging.debug('Seeded %s random binary files in %s', num_of_files, folder_name)
 
-    def get_files(self, folder_name):
-        """Function to return all files in a folder"""
-        files = ''
-        for entry in os.scandir(folder_name):
-            if entry.is_file():
-                files += f'   |--- {os.path.basename(entry.path)}\n' # Style it nicely
-        return files
+    def load_index(self):
+        """Function to reuse the hashes and compressed copies saved by earlier runs"""
+        try:
+            with open(self.index_path, encoding=ENCODING) as file:
+                index = json.load(file)
+            digests = {(path, size, mtime): digest
+                       for path, size, mtime, digest in index.get('digests', [])}
+            compressed = {(path, codec): (size, mtime, copy)
+                          for path, codec, size, mtime, copy in index.get('compressed', [])}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError) as error:
+            logging.warning('Ignoring unreadable index %s: %s', self.index_path, error)
+            return
+        # Anything worked out since startup is newer, so keep it
+        for key, digest in digests.items():
+            self.digests.setdefault(key, digest)
+        for key, entry in compressed.items():
+            self.compressed.setdefault(key, entry)
+        logging.info('Loaded %s hashes and %s compressed copies from %s',
+                     len(digests), len(compressed), self.index_path)
 
-    def get_message(self, client):
-        """Function to receive full messages with header size"""
-        # For the first recv, the file size is retrieved
-        # Also checks for if client is alive
-        message_length = None
-        while message_length is None:
+    def save_index(self):
+        """Function to save the hashes and compressed copies for the next run"""
+        # Keep only the newest entry of each file
+        digests = {}
+        for (path, size, mtime), digest in list(self.digests.items()):
+            if path not in digests or digests[path][2] < mtime:
+                digests[path] = [path, size, mtime, digest]
+        compressed = [[path, codec, *entry] for (path, codec), entry in list(self.compressed.items())]
+        # Workers share the folder, so each writes a temporary file of its own
+        temporary = f'{self.index_path}.{os.getpid()}.tmp'
+        with self.index_lock:
             try:
-                message_length = client.recv(HEADERSIZE).decode(ENCODING)
-                if not message_length:
-                    return ''
+                with open(temporary, 'w', encoding=ENCODING) as file:
+                    json.dump({'digests': list(digests.values()), 'compressed': compressed}, file)
+                os.replace(temporary, self.index_path)
+            except OSError as error:
+                logging.warning('Could not save index %s: %s', self.index_path, error)
+
+    def open_file(self, folder_name, file_name):
+        """Function to open a file in a folder for streaming, None if it is not there"""
+        # Only plain names are allowed, so requests cannot escape the folder
+        if not file_name or file_name != os.path.basename(file_name) or file_name[0] == '.':
+            return None
+        # Names not in the index are refused without touching the disk
+        if self.catalogue.lookup(file_name) is None:
+            return None
+        try:
+            return open(os.path.join(folder_name, file_name), 'rb') # pylint: disable=consider-using-with
+        except OSError:
+            return None
+
+    def get_digest(self, file_data, callback):
+        """Function to call back with the hash of an open file, None if it could not be read.
+        Files not hashed since they last changed are hashed in the background"""
+        stat = os.fstat(file_data.fileno())
+        key = (file_data.name, stat.st_size, stat.st_mtime_ns)
+        digest = self.digests.get(key)
+        if digest is not None:
+            callback(digest)
+            return
+        with self.hash_lock:
+            # Clients asking for the same file at once share one pass over it
+            waiting = self.hashing.get(key)
+            if waiting is not None:
+                waiting.append(callback)
+                return
+            self.hashing[key] = [callback]
+        thread = threading.Thread(target=self.hash_file, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def hash_file(self, key):
+        """Function to hash a file, then call back everyone waiting for it"""
+        digest = None
+        try:
+            with open(key[0], 'rb') as file:
+                digest = file_digest(file)
+                stat = os.fstat(file.fileno())
+            # A file replaced or written to meanwhile no longer matches what is being sent
+            if (stat.st_size, stat.st_mtime_ns) != key[1:]:
+                digest = None
+        except OSError as error:
+            logging.warning('Could not hash %s: %s', key[0], error)
+        if digest is not None:
+            self.digests[key] = digest
+            self.save_index()
+        with self.hash_lock:
+            callbacks = self.hashing.pop(key)
+        for callback in callbacks:
+            self.call_soon(callback, digest)
+
+    def call_soon(self, callback, *args):
+        """Function to run a callback handed over by a background thread. Every thread
+        here may touch the clients, so it runs straight away"""
+        callback(*args)
+
+    def compressed_file(self, file_data, codec):
+        """Function to open the compressed copy of a file, None until it is ready or if it does not help"""
+        stat = os.fstat(file_data.fileno())
+        source = (stat.st_size, stat.st_mtime_ns)
+        key = (file_data.name, codec.name)
+        entry = self.compressed.get(key)
+        if entry is not None and entry[:2] == source:
+            if entry[2] is None:
+                return None
+            try:
+                return open(entry[2], 'rb') # pylint: disable=consider-using-with
+            except OSError:
+                # The copy was removed, so make it again next time
+                self.compressed.pop(key, None)
+                return None
+
+        if (stat.st_size < self.compress_min_size or
+                os.path.splitext(file_data.name)[1].lower() in INCOMPRESSIBLE):
+            self.compressed[key] = (*source, None)
+        elif key not in self.compressing:
+            # Compress in the background and send this request uncompressed
+            self.compressing.add(key)
+            thread = threading.Thread(target=self.compress_file, args=(key, codec, source))
+            thread.daemon = True
+            thread.start()
+        return None
+
+    def compress_file(self, key, codec, source):
+        """Function to write the compressed copy of a file next to it for later downloads"""
+        path = key[0]
+        folder = os.path.join(os.path.dirname(path), '.compressed')
+        target = os.path.join(folder, f'{os.path.basename(path)}.{codec.name}')
+        # Workers may compress the same file at once, so each writes a temporary file of its own
+        temporary = f'{target}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(folder, exist_ok=True)
+            compressor = codec.compressor()
+            with open(path, 'rb') as file, open(temporary, 'wb') as output:
+                while chunk := file.read(1 << 20):
+                    output.write(compressor.compress(chunk))
+                output.write(compressor.flush())
+                stat = os.fstat(file.fileno())
+                changed = (stat.st_size, stat.st_mtime_ns) != source
+                smaller = output.tell() < source[0]
+            if changed:
+                # Written while the file was changing, the next request tries again
+                os.unlink(temporary)
+                return
+            if smaller:
+                os.replace(temporary, target)
+            else:
+                os.unlink(temporary)
+            self.compressed[key] = (*source, target if smaller else None)
+            self.save_index()
+            logging.debug('Compressed %s with %s, %s', path, codec.name,
+                          'ready' if smaller else 'no smaller')
+        except OSError as error:
+            logging.warning('Could not compress %s: %s', path, error)
+        finally:
+            self.compressing.discard(key)
+
+    def stats(self, consumer=None):
+        """Function to gather the metrics with the current clients and send queues,
+        with rates since the consumer last asked"""
+        snapshot = self.metrics.snapshot(consumer)
+        # Copy first, other threads may join or leave meanwhile
+        clients = dict(self.clients)
+        queues = sorted(((len(queue), queue.size, clients.get(client, (None, None))[1])
+                         for client, queue in list(self.queues.items())),
+                        key=lambda entry: entry[:2], reverse=True)
+        snapshot['clients'] = len(clients)
+        snapshot['channels'] = len(self.channels)
+        snapshot['queues'] = {
+            'depth_max': queues[0][0] if queues else 0,
+            'depth_mean': sum(entry[0] for entry in queues) / len(queues) if queues else 0,
+            'bytes': sum(entry[1] for entry in queues),
+            # Only the deepest few, so the reply stays small with many clients
+            'deepest': [{'username': name, 'messages': depth, 'bytes': size}
+                        for depth, size, name in queues[:10]],
+        }
+        return snapshot
+
+    def dump_stats(self, file_name, interval):
+        """Function to append a JSON line of stats to a file every interval seconds"""
+        while self.running:
+            time.sleep(interval)
+            try:
+                with open(file_name, 'a', encoding=ENCODING) as file:
+                    # Workers may share the file, so say which process wrote each line
+                    file.write(json.dumps({'time': time.time(), 'pid': os.getpid(),
+                                           **self.stats('stats_file')}) + '\n')
+            except OSError as error:
+                logging.warning('Could not write stats to %s: %s', file_name, error)
+
+    def get_hello(self, client):
+        """Function to agree on framing with a new client, None if it disconnected"""
+        # Peek so a legacy client's first header is left for get_message
+        first = None
+        while first is None:
+            try:
+                first = client.recv(1, socket.MSG_PEEK)
             except socket.timeout:
                 continue
             except ConnectionResetError:
-                return ''
+                return None
+        if not first:
+            return None
+        if first != HELLO[:1]:
+            return LEGACY
 
-        message_length = int(message_length)
-        full_message = ''
-        while True:
-            # Receive either 8192, or the remaining, whichever is smaller
-            # since we do not want to read into the next data
-            try:
-                message = client.recv(min(message_length, 8192)).decode(ENCODING)
-            except ConnectionResetError:
-                return ''
+        try:
+            hello = recv_exact(client, len(HELLO) + 1)
+            if hello[:len(HELLO)] != HELLO:
+                return None
+            # Settle on the highest binary version both sides know
+            version = min(max(hello[-1], BINARY), VERSION)
+            send_frame(client, hello_reply(version), version)
+        except OSError:
+            return None
+        return version
 
-            if not message:
-                return ''
-            message_length -= len(message)
-            full_message += message
-            if not message_length:
-                return full_message
-
-    def broadcast(self, message, mode=0, broadcaster=None, broadcastee=None):
-        """Function to send messages"""
+    def configure(self, client):
+        """Function to set the options of an accepted socket"""
+        # Frames are gathered into whole writes here, so Nagle would only add delay
+        set_tcp_option(client, socket.TCP_NODELAY, 1)
+        # Let the kernel find peers that vanished without closing, even when nothing is sent
+        try:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except OSError:
+            pass
+        for option, value in KEEPALIVE_OPTIONS:
+            set_tcp_option(client, option, value)
+
+    def admit(self, client, address):
+        """Function to accept a connection under the caps and start its handshake clock,
+        closing it straight away when over a cap"""
+        if not self.limits.admit(address[0]):
+            self.metrics.add('refused')
+            logging.warning('Refused connection from %s, too many connections', address)
+            client.close()
+            return False
+        self.handshakes[client] = time.monotonic() + self.handshake_timeout
+        return True
+
+    def start_limits(self, client):
+        """Function to stop the handshake clock of a client that joined and limit its rate"""
+        self.handshakes.pop(client, None)
+        self.throttles[client] = Throttle(*self.rates)
+        self.seen[client] = time.monotonic()
+
+    def release(self, client, address):
+        """Function to forget the limits of a closed connection"""
+        self.limits.release(address[0])
+        self.handshakes.pop(client, None)
+        self.throttles.pop(client, None)
+        self.seen.pop(client, None)
+        self.pinged.pop(client, None)
+
+    def reap(self):
+        """Function to close connections stuck in their handshake, ping quiet clients
+        and disconnect those that stopped answering"""
+        now = time.monotonic()
+        for client, deadline in list(self.handshakes.items()):
+            if now > deadline and self.handshakes.pop(client, None) is not None:
+                self.metrics.add('handshake_timeouts')
+                logging.info('Closed connection that did not join within %s seconds',
+                             self.handshake_timeout)
+                self.abort(client)
+
+        if not self.idle_timeout:
+            return
+        for client in list(self.clients):
+            queue = self.queues.get(client)
+            # Older clients cannot answer pings, so only TCP keepalive watches them
+            if queue is None or queue.version < KEEPALIVE:
+                continue
+            quiet = now - self.seen.get(client, now)
+            if quiet > self.idle_timeout:
+                self.metrics.add('reaped')
+                logging.info('Disconnecting %s after %d seconds without a reply',
+                             self.clients.get(client, (None, None))[1], quiet)
+                self.abort(client)
+            elif queue:
+                # Frames still waiting already show the client is behind, a ping would only add to them
+                continue
+            elif quiet > self.ping_interval and now - self.pinged.get(client, 0) > self.ping_interval:
+                self.pinged[client] = now
+                self.metrics.add('pings')
+                try:
+                    self.send(client, PING)
+                except SendQueueFull:
+                    self.metrics.add('overflows')
+                    logging.warning('Send queue of %s overflowed', self.clients[client][1])
+                    self.kill_connection(client)
+
+    def reaper(self):
+        """Function to reap stale connections every second until the server closes"""
+        while self.running:
+            time.sleep(1)
+            self.reap()
+
+    def abort(self, client):
+        """Function to cut off a connection, left for its own thread to clean up"""
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def make_reader(self, client, version):
+        """Function to create the receive buffer for a client's messages, which only
+        takes full size messages once the client is let in"""
+        return FrameReader(client, version, typed=False, max_size=MAX_FIRST_MESSAGE)
+
+    def get_message(self, reader):
+        """Function to receive full messages with header size"""
+        # Also checks for if client is alive
+        try:
+            while (frame := reader.read()) is not None:
+                message = self.decode(reader.sock, frame)
+                if message is not None:
+                    return message
+        except (ConnectionResetError, ValueError):
+            return ''
+        return ''
+
+    def decode(self, client, frame):
+        """Function to turn a received frame into text, None for control frames"""
+        message_type, flags, body = frame
+        self.metrics.received(message_type, len(body))
+        self.seen[client] = time.monotonic()
+        throttle = self.throttles.get(client)
+        if throttle is not None:
+            throttle.take(len(body))
+        if message_type == PING_MSG:
+            return None
+        if message_type == CODECS_MSG:
+            self.set_codec(client, str(body, ENCODING, errors='replace').split())
+            return None
+        if flags & CODEC_MASK:
+            body = decompress(flags, body, MAX_MESSAGE)
+        # Decode once the whole message is in, so characters split across reads survive
+        return str(body, ENCODING, errors='replace')
+
+    def set_codec(self, client, names):
+        """Function to choose how to compress frames for a client out of the codecs it can decode"""
+        codec = choose_codec(names) if self.compression else None
+        queue = self.queues.get(client)
+        if queue is not None:
+            queue.codec = codec
+        else:
+            self.codecs[client] = codec
+
+    def broadcast(self, message, mode=0, broadcaster=None, broadcastee=None, relay=True,
+                  channels=None):
+        """Function to send messages, in modes 1 and 2 only to members of channels if given"""
         # Keep pre_encoded message for logging
         pre_encoded_message = message
 
-        if isinstance(message, bytes):
-            # For binary data, send as-is without encoding main data
-            # First bit in header is for type of message
-            header = f'{FILE_MSG}{len(message):<{HEADERSIZE-1}}'.encode(ENCODING)
-            message = header + message
-        else:
-            message = f'{TEXT_MSG}{len(message):<{HEADERSIZE-1}}' + message
-            message = message.encode(ENCODING)
+        # Other workers relay chat and announcements to their own clients
+        if self.bus is not None and relay and mode in (1, 2) and isinstance(message, str):
+            self.bus.send({'op': 'broadcast', 'text': message, 'channels': channels,
+                           'chat': mode == 2})
+
+        # Encode once, every recipient shares the same header and body buffers
+        message = make_frame(message)
+        started = time.perf_counter_ns()
 
         # Variable to keep track of disconnected clients whilst broadcasting
         disconnected_clients = []
         match mode:
             # Broadcast to all (Server mode)
             case 1:
-                for client in self.clients:
+                for client in self.members(channels):
                     try:
-                        client.sendall(message)
-                    except ConnectionResetError:
+                        self.send(client, message)
+                    except (ConnectionResetError, SendQueueFull):
                         disconnected_clients.append(client)
+                    except OSError:
+                        # The client left while the message went out, so its socket is closed
+                        pass
             # Broadcast to all but broadcaster
             case 2:
-                for client in self.clients:
+                for client in self.members(channels):
                     try:
                         if client != broadcaster:
-                            client.sendall(message)
-                    except ConnectionResetError:
+                            self.send(client, message)
+                    except (ConnectionResetError, SendQueueFull):
                         disconnected_clients.append(client)
-                logging.info("Broadcast '%s' to all but %s",
+                    except OSError:
+                        # The client left while the message went out, so its socket is closed
+                        pass
+                # Message text is only logged when debugging, it is not an audit event
+                logging.debug("Broadcast '%s' to all but %s",
                             pre_encoded_message, self.clients[broadcaster][1])
             # Broadcast to individual
             case 3:
-                broadcastee.sendall(message)
+                try:
+                    self.send(broadcastee, message)
+                except SendQueueFull:
+                    disconnected_clients.append(broadcastee)
+        self.metrics.observe('broadcast_ns', time.perf_counter_ns() - started)
 
         # Remove disconnected clients
         for client in disconnected_clients:
-            self.kill_connection(client)
+            if client in self.clients:
+                self.metrics.add('overflows')
+                logging.warning('Send queue of %s overflowed', self.clients[client][1])
+                self.kill_connection(client)
+
+    def members(self, channels=None):
+        """Function to return the clients in any of the channels, every client if None"""
+        # Copied, as handler threads may join or part while the caller loops
+        if channels is None:
+            return list(self.clients)
+        if len(channels) == 1:
+            return list(self.channels.get(channels[0], ()))
+        # A client in several of the channels is only counted once
+        return list(set().union(*(self.channels.get(channel, ()) for channel in channels)))
+
+    def add_member(self, client, channel):
+        """Function to make a client talk in a channel, adding it to the members
+        if needed. Returns whether it was added"""
+        joined = self.memberships.setdefault(client, [])
+        added = channel not in joined
+        if not added:
+            joined.remove(channel)
+        joined.append(channel)
+        self.channels.setdefault(channel, set()).add(client)
+        return added
+
+    def remove_member(self, client, channel):
+        """Function to remove a client from a channel, forgetting the channel once empty"""
+        self.memberships[client].remove(channel)
+        members = self.channels.get(channel, set())
+        members.discard(client)
+        if not members:
+            self.channels.pop(channel, None)
+
+    def chat(self, client, message):
+        """Function to send a client's message to the channel it talks in"""
+        joined = self.memberships.get(client)
+        username = self.clients[client][1]
+        if not joined:
+            self.broadcast('[SERVER]: You are not in any channel, type /join [channel]',
+                           mode=3, broadcastee=client)
+            return
+        channel = joined[-1]
+        if channel == DEFAULT_CHANNEL:
+            message = f'[{username}]: {message}'
+        else:
+            message = f'[{username} (#{channel})]: {message}'
+        if self.history is not None:
+            self.history.append(channel, message)
+        self.broadcast(message, mode=2, broadcaster=client, channels=(channel,))
+
+    def make_queue(self, version=LEGACY, codec=None):
+        """Function to create an outbound queue with the configured cap"""
+        return SendQueue(max_bytes=self.queue_bytes, max_messages=self.queue_messages,
+                         overflow=self.overflow, version=version, codec=codec,
+                         compress_min_size=self.compress_min_size, metrics=self.metrics)
+
+    def send(self, client, message):
+        """Function to queue a frame for a client's writer thread"""
+        queue = self.queues.get(client)
+        if queue is None:
+            # Not joined yet, so there is no writer thread to hand over to
+            send_frame(client, message)
+        else:
+            queue.put(message)
+
+    def write(self, client, queue):
+        """Function to drain a client's send queue so slow clients only delay themselves.
+        Everything queued by the time the socket is written goes out in one call"""
+        while queue.wait(self.coalesce_window):
+            try:
+                queue.send(client)
+            except (socket.timeout, BlockingIOError):
+                if queue.closed:
+                    return
+                # Streaming files bypasses the socket timeout, so wait here instead
+                select.select([], [client], [], 1)
+            except OSError:
+                # Wake up the handler thread so it removes the client
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
 
     def kill_connection(self, client):
         """Function to kill connection to unresponsive clients"""
+        # The handler and another client's broadcast may both notice the same failure
+        if client not in self.clients:
+            return
         address, username = self.clients[client]
+        queue = self.queues.pop(client, None)
+        if queue is not None:
+            queue.close()
         client.close()
         self.clients.pop(client)
         self.taken_names.pop(username)
-        self.broadcast(f'[SERVER]: {username} just left. Goodbye!', mode=1)
+        channels = list(self.memberships.get(client, ()))
+        for channel in channels:
+            self.remove_member(client, channel)
+        self.memberships.pop(client, None)
+        self.metrics.add('leaves')
+        if self.bus is not None:
+            self.bus.send({'op': 'release', 'name': username})
+        # Only those sharing a channel with the client are told
+        self.broadcast(f'[SERVER]: {username} just left. Goodbye!', mode=1, channels=channels)
         logging.info("Broadcasted '%s just left. Goodbye!'", username)
         logging.info('Disconnected with %s. Remove client named %s', address, username)
         print(f"Disconnected with {address}. Remove client named {username}")
@@ -159,23 +930,28 @@ class Server:
     def run_command(self, command, client=None):
         """Function to run commands when a forward slash given"""
         command_type = command.split(' ')[0]
+        self.metrics.add('commands')
         match command_type:
             case 'download':
                 # If only /download, return the download folder content
                 if command_type == command:
-                    message = self.get_files('download')
-                    self.broadcast('[SERVER]: The following files are in ' +
-                                   '[download]\n\ndownload/\n' + message +
-                                   '\n[SERVER]: To download a file, type /download [file_name]',
-                                   mode=3, broadcastee=client)
-                    logging.info("Unicast files in download folder to %s", self.clients[client][1])
+                    self.send_listing(client)
                 else:
-                    _, file_name = command.split(' ')
-                    file_path = os.path.join('download', file_name)
-                    if file_name and os.path.exists(file_path):
-                        with open(file_path, 'rb') as file_data:
-                            file_content = file_data.read()
-                            self.broadcast(file_content, mode=3, broadcastee=client)
+                    # Newer clients add a byte offset and optional end to resume or split
+                    _, file_name, *byte_range = command.split(' ')
+                    if file_name.endswith('*'):
+                        # A listing filtered as /download [prefix]* [page]
+                        self.send_listing(client, file_name[:-1], byte_range)
+                        return
+                    file_data = self.open_file(self.download_folder, file_name)
+                    if file_data is not None and byte_range:
+                        self.send_range(client, file_name, file_data, byte_range,
+                                        self.queues[client].codec)
+                    elif file_data is not None:
+                        # The file is streamed from disk and closed by its frame once sent
+                        frame = make_file_frame(file_data)
+                        if self.check_fits(client, frame):
+                            self.broadcast(frame, mode=3, broadcastee=client)
                             logging.info("Unicast file named %s to %s",
                                         file_name, self.clients[client][1])
                     else:
@@ -184,9 +960,10 @@ class Server:
                         logging.info("Unicast 'File requested does not exist' to %s",
                                     self.clients[client][1])
 
-            case 'whisper':
+            # Without a target and a message it falls through to an invalid command
+            case 'whisper' if len(command.split(' ', 2)) == 3:
                 _, target, message = command.split(' ', 2)
-                if target not in self.taken_names:
+                if target not in self.taken_names and target not in self.remote_names:
                     self.broadcast('[SERVER]: Username does not exist', mode=3, broadcastee=client)
                     logging.info("Unicast 'Username does not exist' to %s",
                                 self.clients[client][1])
@@ -195,31 +972,338 @@ class Server:
                                    mode=3, broadcastee=client)
                     logging.info("Unicast 'You cannot whisper to yourself' to %s",
                                 self.clients[client][1])
-                elif len(self.clients) < 3:
+                elif len(self.clients) + len(self.remote_names) < 3:
                     self.broadcast('[SERVER]: You cannot whisper' +
                                    ' when there are only you and someone else',
                                    mode=3, broadcastee=client)
                     logging.info("Unicast 'You cannot whisper" +
                                 " when there are only you and someone else' to %s",
                                 self.clients[client][1])
+                elif target not in self.taken_names:
+                    # The target joined through another worker, which delivers it
+                    self.bus.send({'op': 'whisper', 'to': target,
+                                   'text': f'[{self.clients[client][1]} (WHISPER)]: {message}'})
+                    logging.debug("%s relayed '%s' to %s",
+                                 self.clients[client][1], message, target)
                 else:
                     self.broadcast(f'[{self.clients[client][1]} (WHISPER)]: {message}',
                                mode=3, broadcastee=self.taken_names[target])
-                    logging.info("%s unicast '%s' to %s",
+                    logging.debug("%s unicast '%s' to %s",
                                 self.clients[client][1], message, target)
 
+            case 'join':
+                self.join_channel(client, command.split(' ')[1:])
+
+            case 'part':
+                self.part_channel(client, command.split(' ')[1:])
+
+            case 'history':
+                self.send_history(client, command.split(' ')[1:])
+
             case 'leave':
                 self.kill_connection(client)
 
+            case 'stats':
+                # Only clients on the server's own machine may see its internals
+                if ipaddress.ip_address(self.clients[client][0][0]).is_loopback:
+                    self.broadcast('[SERVER]: ' + json.dumps(self.stats('command'), indent=2),
+                                   mode=3, broadcastee=client)
+                else:
+                    self.broadcast('[SERVER]: /stats is only available on the server machine',
+                                   mode=3, broadcastee=client)
+                logging.info('Unicast stats to %s', self.clients[client][1])
+
             case _:
+                self.metrics.add('invalid_commands')
                 self.broadcast('[SERVER]: Invalid command', mode=3, broadcastee=client)
                 logging.info("Unicast 'Invalid command' to %s", self.clients[client][1])
 
-    def handle(self, client):
+    def join_channel(self, client, names):
+        """Function to join or switch to a channel, or list the client's channels if none given"""
+        username = self.clients[client][1]
+        joined = self.memberships.get(client, [])
+        if not names:
+            if joined:
+                channels = ', '.join(f'#{channel}' for channel in joined)
+                self.broadcast(f'[SERVER]: You are in {channels}, talking in #{joined[-1]}',
+                               mode=3, broadcastee=client)
+            else:
+                self.broadcast('[SERVER]: You are not in any channel',
+                               mode=3, broadcastee=client)
+            return
+
+        channel = names[0].removeprefix('#')
+        if not CHANNEL_NAME.fullmatch(channel):
+            self.broadcast('[SERVER]: Channel names are 1 to 32 letters, digits, - or _',
+                           mode=3, broadcastee=client)
+            logging.info("Unicast 'Invalid channel name' to %s", username)
+        elif self.add_member(client, channel):
+            self.broadcast(f'[SERVER]: {username} joined #{channel}', mode=1, channels=(channel,))
+            logging.info("Broadcast '%s joined #%s'", username, channel)
+        else:
+            self.broadcast(f'[SERVER]: Now talking in #{channel}', mode=3, broadcastee=client)
+
+    def part_channel(self, client, names):
+        """Function to leave a channel, the one the client talks in if none given"""
+        username = self.clients[client][1]
+        joined = self.memberships.get(client, [])
+        if names:
+            channel = names[0].removeprefix('#')
+        else:
+            channel = joined[-1] if joined else None
+        if channel not in joined:
+            self.broadcast('[SERVER]: You are not in that channel', mode=3, broadcastee=client)
+            logging.info("Unicast 'You are not in that channel' to %s", username)
+            return
+
+        # Announce first, so the client leaving sees it too
+        self.broadcast(f'[SERVER]: {username} left #{channel}', mode=1, channels=(channel,))
+        logging.info("Broadcast '%s left #%s'", username, channel)
+        self.remove_member(client, channel)
+        if joined:
+            self.broadcast(f'[SERVER]: Now talking in #{joined[-1]}', mode=3, broadcastee=client)
+
+    def send_history(self, client, count=()):
+        """Function to replay the newest messages of the channel a client talks in"""
+        username = self.clients[client][1]
+        joined = self.memberships.get(client)
+        if self.history is None:
+            self.broadcast('[SERVER]: History is not kept on this server',
+                           mode=3, broadcastee=client)
+            return
+        if not joined:
+            self.broadcast('[SERVER]: You are not in any channel', mode=3, broadcastee=client)
+            return
+        try:
+            count = min(max(int(count[0]), 1), HISTORY_MAX) if count else HISTORY_DEFAULT
+        except ValueError:
+            self.broadcast('[SERVER]: Type /history [count]', mode=3, broadcastee=client)
+            return
+
+        channel = joined[-1]
+        messages = self.history.last(channel, count)
+        lines = [f'[SERVER]: Last {len(messages)} messages in #{channel}']
+        lines.extend(f'{time.strftime("%H:%M:%S", time.localtime(when))} {text}'
+                     for when, text in messages)
+        # Sent as one message, so the replay costs a single write
+        self.broadcast('\n'.join(lines), mode=3, broadcastee=client)
+        logging.info('Unicast %d messages of #%s history to %s', len(messages), channel, username)
+
+    def send_listing(self, client, prefix='', page=()):
+        """Function to send one page of the files starting with prefix"""
+        try:
+            number = int(page[0]) if page else 1
+        except ValueError:
+            number = 1
+        # The page is encoded once and shared until the folder changes
+        self.broadcast(self.catalogue.page(prefix, number), mode=3, broadcastee=client)
+        logging.info("Unicast files in download folder to %s", self.clients[client][1])
+
+    def check_fits(self, client, frame):
+        """Function to refuse a frame too long for the client's framing, telling the client why"""
+        if fits(frame, self.queues[client].version):
+            return True
+        frame.close()
+        self.broadcast('[SERVER]: File is too large for your client, please update it',
+                       mode=3, broadcastee=client)
+        logging.info("Unicast 'File is too large for your client' to %s", self.clients[client][1])
+        return False
+
+    def parse_range(self, file_data, byte_range):
+        """Function to read a byte range of a file as (size, start, end), None if out of range"""
+        size = os.fstat(file_data.fileno()).st_size
+        try:
+            start = min(int(byte_range[0]), size)
+            end = min(int(byte_range[1]), size) if len(byte_range) > 1 else size
+        except (ValueError, IndexError):
+            return None
+        if len(byte_range) > 2 or not 0 <= start <= end:
+            return None
+        return size, start, end
+
+    def range_frames(self, file_data, span, digest, codec=None):
+        """Function to frame part of a file preceded by its size, hash and name"""
+        size, start, end = span
+        # Naming the file lets clients with several downloads pending tell them apart
+        file_name = os.path.basename(file_data.name)
+        info = make_frame(f'{size} {start} {end} {DIGEST} {digest} {file_name}', FILE_INFO_MSG)
+        # Whole files are sent from their compressed copy once one is ready
+        compressed = None
+        if codec is not None and start == 0 and end == size:
+            compressed = self.compressed_file(file_data, codec)
+        if compressed is not None:
+            file_data.close()
+            return info, make_file_frame(compressed, flags=codec.flag)
+        # The file is streamed from disk and closed by its frame once sent
+        return info, make_file_frame(file_data, start, end - start)
+
+    def send_range(self, client, file_name, file_data, byte_range, codec=None):
+        """Function to send part of a file once it has been hashed, preceded by its size
+        and hash for checking"""
+        span = self.parse_range(file_data, byte_range)
+        if span is None:
+            file_data.close()
+            self.broadcast('[SERVER]: Invalid byte range', mode=3, broadcastee=client)
+            logging.info("Unicast 'Invalid byte range' to %s", self.clients[client][1])
+            return
+
+        # Ranges wait for their hash in the order asked, so files arrive in that order too
+        pending = PendingRange(file_name, file_data, span, codec)
+        with self.hash_lock:
+            self.ranges.setdefault(client, collections.deque()).append(pending)
+        self.get_digest(file_data, lambda digest: self.range_ready(client, pending, digest))
+
+    def range_ready(self, client, pending, digest):
+        """Function to send a client's ranges whose files are hashed, up to the first still waiting"""
+        pending.digest = digest
+        pending.ready = True
+        with self.hash_lock:
+            waiting = self.ranges.get(client, ())
+            while waiting and waiting[0].ready:
+                self.send_pending(client, waiting.popleft())
+            if not waiting:
+                self.ranges.pop(client, None)
+
+    def send_pending(self, client, pending):
+        """Function to send a range now that its file has been hashed"""
+        # The client may have left while the file was hashed
+        if client not in self.clients:
+            pending.file_data.close()
+            return
+        if pending.digest is None:
+            pending.file_data.close()
+            self.broadcast('[SERVER]: File changed while being read, please try again',
+                           mode=3, broadcastee=client)
+            logging.info("Unicast 'File changed while being read' to %s", self.clients[client][1])
+            return
+
+        info, body = self.range_frames(pending.file_data, pending.span, pending.digest,
+                                       pending.codec)
+        if not self.check_fits(client, body):
+            return
+        self.broadcast(info, mode=3, broadcastee=client)
+        # The client is dropped if its queue overflowed under the disconnect policy
+        if client not in self.clients:
+            body.close()
+            return
+        self.broadcast(body, mode=3, broadcastee=client)
+        logging.info("Unicast %s bytes of file named %s to %s",
+                    body.count, pending.file_name, self.clients[client][1])
+
+    def fetch_frames(self, request, version, callback):
+        """Function to answer '/fetch [username] [file_name] [start] [end]' from a data connection,
+        calling back with the frames to send once the file has been hashed"""
+        parts = request.split(' ')
+        file_data = span = None
+        # Only joined users may open extra connections to download in parallel
+        if len(parts) > 2 and (parts[1] in self.taken_names or parts[1] in self.remote_names):
+            file_data = self.open_file(self.download_folder, parts[2])
+        if file_data is not None:
+            span = self.parse_range(file_data, parts[3:])
+            if span is None:
+                file_data.close()
+        if span is None:
+            callback(self.refuse_fetch(request))
+            return
+
+        def ready(digest):
+            if digest is None:
+                file_data.close()
+                callback(self.refuse_fetch(request))
+                return
+            frames = self.range_frames(file_data, span, digest)
+            if not fits(frames[1], version):
+                frames[1].close()
+                callback(self.refuse_fetch(request))
+                return
+            logging.info("Sending %s bytes of file named %s over a data connection of %s",
+                        frames[1].count, parts[2], parts[1])
+            callback(frames)
+        self.get_digest(file_data, ready)
+
+    def refuse_fetch(self, request):
+        """Function to return the reply to a data connection asking for something it cannot have"""
+        logging.info("Refused data connection asking '%s'", request)
+        return (make_frame('[SERVER]: Invalid fetch'),)
+
+    def fetch(self, client, request, version):
+        """Function to serve a data connection, then close it"""
+        # This is the connection's own thread, so it can wait for the file to be hashed
+        answer = queue.SimpleQueue()
+        self.fetch_frames(request, version, answer.put)
+        frames = answer.get()
+        # Block without a timeout, the data connection carries nothing else
+        client.settimeout(None)
+        try:
+            for frame in frames:
+                started = time.perf_counter_ns()
+                send_frame(client, frame, version)
+                self.metrics.sent(frame, time.perf_counter_ns() - started)
+        except OSError:
+            pass
+        finally:
+            for frame in frames:
+                frame.close()
+            client.close()
+
+    def claim(self, username, callback):
+        """Function to ask the hub to reserve a username across workers, calling back with the answer"""
+        # Handler threads claim at the same time, so ids come from a shared counter
+        claim_id = next(self.claim_ids)
+        self.claims[claim_id] = callback
+        self.bus.send({'op': 'claim', 'name': username, 'id': claim_id})
+        return claim_id
+
+    def claim_wait(self, username, timeout=5):
+        """Function to reserve a username across workers, blocking until the hub answers"""
+        answer = queue.SimpleQueue()
+        claim_id = self.claim(username, answer.put)
+        try:
+            return answer.get(timeout=timeout)
+        except queue.Empty:
+            # The hub answers in order, so this gives the name back should it grant it late
+            self.claims.pop(claim_id, None)
+            self.bus.send({'op': 'release', 'name': username})
+            return False
+
+    def on_bus(self, message):
+        """Function to act on a message relayed from another worker by the hub"""
+        match message.get('op'):
+            case 'claimed':
+                callback = self.claims.pop(message['id'], None)
+                if callback is not None:
+                    callback(message['ok'])
+            case 'joined':
+                self.remote_names.add(message['name'])
+            case 'left':
+                self.remote_names.discard(message['name'])
+            case 'broadcast':
+                # Every worker keeps all chat, so any of them can replay it
+                if message.get('chat') and self.history is not None:
+                    self.history.append(message['channels'][0], message['text'])
+                self.broadcast(message['text'], mode=1, relay=False,
+                               channels=message.get('channels'))
+            case 'whisper':
+                target = self.taken_names.get(message['to'])
+                if target is not None:
+                    self.broadcast(message['text'], mode=3, broadcastee=target)
+
+    def serve_bus(self):
+        """Function to act on messages from the hub until it goes away"""
+        while (message := self.bus.receive()) is not None:
+            self.on_bus(message)
+        self.lose_hub()
+
+    def lose_hub(self):
+        """Function to stop a worker whose hub has gone, as usernames can no longer be checked"""
+        logging.error('Lost connection to the hub, stopping')
+        signal.raise_signal(signal.SIGINT)
+
+    def handle(self, client, reader):
         """Function to handle messages received from clients"""
         while True:
             try:
-                message = self.get_message(client)
+                message = self.get_message(reader)
                 if not message:
                     if not self.running:
                         sys.exit(0)
@@ -227,68 +1311,660 @@ class Server:
                 elif message[0] == '/':
                     self.run_command(message[1:], client=client)
                 else:
-                    self.broadcast(f'[{self.clients[client][1]}]: ' + message,
-                                   mode=2, broadcaster=client)
+                    self.chat(client, message)
+                # A client over its rate limit is not read from until it is back under,
+                # so it only slows itself down
+                throttle = self.throttles.get(client)
+                delay = throttle.delay() if throttle is not None else 0
+                if delay:
+                    self.metrics.add('throttled')
+                    time.sleep(delay)
             except OSError:
                 sys.exit(0)
 
     def run(self):
         """Function to run the server"""
+        if self.bus is not None:
+            thread = threading.Thread(target=self.serve_bus)
+            thread.daemon = True
+            thread.start()
+        thread = threading.Thread(target=self.reaper)
+        thread.daemon = True
+        thread.start()
         try:
-            while True:
+            while self.running:
                 # Unblock regularly to check if server should close
-                client = None
-                while not client:
-                    try:
-                        client, address = self.server.accept()
-                    except socket.timeout:
-                        continue
-                    except KeyboardInterrupt:
-                        self.kill_server()
-
-                client.settimeout(1)
-                username = self.get_message(client)
-
-                # Disallow duplicate username in chat
-                if username in self.taken_names:
-                    self.broadcast('[SERVER]: Username taken', mode=3, broadcastee=client)
-                    logging.info("Unicast 'Username taken' to incoming socket")
-                    client.close()
-                    continue
-
-                # Store clients' address and username with the socket as key
-                self.clients[client] = (address, username)
-                self.taken_names[username] = client
-
-                # Broadcast after as it loops over clients dictionary
-                logging.info('Connected with %s. Add client named %s', address, username)
-                print(f'Connected with {address}. Add client named {username}')
-                self.broadcast(f'[SERVER]: {username} just joined. Welcome!', mode=1)
-                logging.info("Broadcast '%s just joined. Welcome!'", username)
-                thread = threading.Thread(target=self.handle, args=(client,))
-                thread.daemon = True
-                thread.start()
+                try:
+                    client, address = self.server.accept()
+                except socket.timeout:
+                    client = None
+
+                # Handshakes run on the connection's own thread, so a slow or
+                # silent client never holds up the next one
+                if client is not None and self.admit(client, address):
+                    thread = threading.Thread(target=self.serve, args=(client, address))
+                    thread.daemon = True
+                    thread.start()
         except KeyboardInterrupt:
             self.kill_server()
+        # Stopped through close()
+        self.close_all()
 
-    def kill_server(self):
-        """Function to close the server gracefully"""
+    def serve(self, client, address):
+        """Function to take a connection from its handshake until it closes"""
+        try:
+            client.settimeout(1)
+            self.configure(client)
+            version = self.get_hello(client)
+            if version is None:
+                client.close()
+                return
+            reader = self.make_reader(client, version)
+            username = self.get_message(reader)
+            codec = self.codecs.pop(client, None)
+            if not username:
+                client.close()
+                return
+
+            # Extra connections opened by a client to download in parallel
+            if username.startswith('/fetch '):
+                self.handshakes.pop(client, None)
+                self.fetch(client, username, version)
+                return
+
+            # Disallow duplicate username in chat, on every worker
+            with self.join_lock:
+                taken = username in self.taken_names or username in self.joining
+                if not taken:
+                    self.joining.add(username)
+            if not taken and self.bus is not None and not self.claim_wait(username):
+                self.joining.discard(username)
+                taken = True
+            if taken:
+                send_frame(client, make_frame('[SERVER]: Username taken'), version)
+                logging.info("Unicast 'Username taken' to incoming socket")
+                client.close()
+                return
+            reader.max_size = MAX_MESSAGE
+
+            # Start the writer first so the welcome below is queued for it
+            queue = self.make_queue(version, codec)
+            self.queues[client] = queue
+            writer = threading.Thread(target=self.write, args=(client, queue))
+            writer.daemon = True
+            writer.start()
+
+            self.join(client, address, username)
+            self.handle(client, reader)
+        finally:
+            self.release(client, address)
+
+    def join(self, client, address, username):
+        """Function to add a client under its username and welcome it"""
+        # Store clients' address and username with the socket as key
+        self.clients[client] = (address, username)
+        self.taken_names[username] = client
+        self.joining.discard(username)
+        self.start_limits(client)
+        self.metrics.add('joins')
+
+        # Broadcast after as it loops over clients dictionary
+        logging.info('Connected with %s. Add client named %s', address, username)
+        print(f'Connected with {address}. Add client named {username}')
+        self.add_member(client, DEFAULT_CHANNEL)
+        self.broadcast(f'[SERVER]: {username} just joined. Welcome!',
+                       mode=1, channels=(DEFAULT_CHANNEL,))
+        logging.info("Broadcast '%s just joined. Welcome!'", username)
+
+    def close(self):
+        """Function to stop the server from another thread, as when it runs inside a benchmark.
+        The server closes once its loop next wakes up"""
+        self.running = False
+
+    def close_all(self):
+        """Function to close the server socket and every client"""
         self.server.close()
-        for client, info in self.clients.items():
+        for client, info in list(self.clients.items()):
             client.close()
             logging.info('Disconnected with %s. Remove client named %s',
                         info[0], info[1])
             print(f"Disconnected with {info[0]}. Remove client named {info[1]}")
+        if self.history is not None:
+            self.history.close()
         logging.warning('Closed server')
-        print('Disconnecting...')
+
+    def kill_server(self):
+        """Function to close the server gracefully"""
         self.running = False
+        self.close_all()
+        print('Disconnecting...')
         sys.exit(0)
 
+class Connection:
+    """Class representing the buffered state of a non-blocking client socket"""
+    def __init__(self, address, reader):
+        self.address = address
+        # Bytes received but not yet parsed into full messages
+        self.reader = reader
+        # Close the socket once the outbound buffer has been flushed
+        self.closing = False
+        # Messages received while the hub checks the username, None when not waiting
+        self.backlog = None
+
+
+class EventServer(Server):
+    """Class representing a server running every connection on one event loop"""
+    def __init__(self, host='127.0.0.1', port=1234, **kwargs):
+        super().__init__(host=host, port=port, **kwargs)
+        # Thousands of clients may connect at once, so allow a long accept queue
+        self.server.listen(socket.SOMAXCONN)
+        self.server.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        if self.bus is not None:
+            self.selector.register(self.bus.sock, selectors.EVENT_READ)
+
+        # Setup storage for buffered state of every open socket, joined or not
+        self.connections = {}
+
+        # Setup sockets with frames queued during this pass of the loop, written
+        # together once it ends or the coalesce window has passed
+        self.unflushed = set()
+        self.flush_at = 0
+
+        # Setup sockets not read from until a time, as they went over their rate limit
+        self.paused = {}
+        self.reap_at = 0
+
+        # Setup callbacks handed over by background threads, run on the loop once
+        # a byte written to the wake socket pair has woken it up
+        self.calls = collections.deque()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+
+    def call_soon(self, callback, *args):
+        """Function to run a callback from a background thread on the event loop"""
+        self.calls.append((callback, args))
+        try:
+            self.wake_writer.send(b'\0')
+        except BlockingIOError:
+            # The buffer is full of wake ups the loop has not read yet
+            pass
+
+    def run_calls(self):
+        """Function to run the callbacks handed over by background threads"""
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.calls:
+            callback, args = self.calls.popleft()
+            callback(*args)
+
+    def send(self, client, message):
+        """Function to queue a frame, written with any others queued for the client
+        once the current pass of the event loop ends"""
+        self.queues[client].put(message)
+        if not self.unflushed:
+            self.flush_at = time.monotonic() + self.coalesce_window
+        self.unflushed.add(client)
+
+    def flush_all(self):
+        """Function to write to every socket that had frames queued since the last pass"""
+        unflushed, self.unflushed = self.unflushed, set()
+        for client in unflushed:
+            # An earlier write may have dropped the client and announced it
+            if client in self.connections:
+                self.flush(client)
+
+    def forget(self, client):
+        """Function to stop watching a socket"""
+        connection = self.connections.pop(client, None)
+        if connection is not None:
+            if client in self.selector.get_map():
+                self.selector.unregister(client)
+            self.queues.pop(client).close()
+            self.paused.pop(client, None)
+            self.release(client, connection.address)
+
+    def watch_events(self, client):
+        """Function to watch a socket for reading unless paused, and for writing
+        while something is queued"""
+        events = 0 if client in self.paused else selectors.EVENT_READ
+        if self.queues[client]:
+            events |= selectors.EVENT_WRITE
+        key = self.selector.get_map().get(client)
+        current = key.events if key is not None else 0
+        if events == current:
+            return
+        if not events:
+            self.selector.unregister(client)
+        elif not current:
+            self.selector.register(client, events)
+        else:
+            self.selector.modify(client, events)
+
+    def abort(self, client):
+        """Function to cut off a connection"""
+        self.drop(client)
+
+    def drop(self, client):
+        """Function to close a socket, announcing the leave if it had joined"""
+        if client in self.clients:
+            self.kill_connection(client)
+        else:
+            self.forget(client)
+            client.close()
+
+    def finish(self, client):
+        """Function to close a socket once everything queued for it has been written"""
+        self.connections[client].closing = True
+        if not self.queues[client]:
+            self.drop(client)
+
+    def kill_connection(self, client):
+        """Function to kill connection to unresponsive clients"""
+        self.forget(client)
+        super().kill_connection(client)
+
+    def accept(self):
+        """Function to accept every pending incoming connection"""
+        while True:
+            try:
+                client, address = self.server.accept()
+            except (BlockingIOError, socket.timeout):
+                return
+            client.setblocking(False)
+            if not self.admit(client, address):
+                continue
+            self.configure(client)
+            # The framing version is unknown until the first bytes arrive
+            self.connections[client] = Connection(address, self.make_reader(client, None))
+            self.queues[client] = self.make_queue()
+            self.selector.register(client, selectors.EVENT_READ)
+
+    def read(self, client):
+        """Function to read available bytes and process every full message"""
+        reader = self.connections[client].reader
+        try:
+            received = reader.fill()
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+
+        if not received:
+            self.drop(client)
+            return
+
+        if reader.version is None and not self.greet(client):
+            return
+        self.parse(client)
+
+    def parse(self, client):
+        """Function to process every full message received, pausing a client that
+        goes over its rate limit with the rest left in its buffer"""
+        reader = self.connections[client].reader
+        while True:
+            try:
+                frame = reader.next_frame()
+                message = None if frame is None else self.decode(client, frame)
+            except ValueError:
+                # Broken framing or compression, nothing after it can be trusted
+                self.drop(client)
+                return
+            if frame is None:
+                return
+            if message is not None:
+                self.process(client, message)
+                # The message may have been /leave, so stop if the socket is gone
+                if client not in self.connections:
+                    return
+            throttle = self.throttles.get(client)
+            delay = throttle.delay() if throttle is not None else 0
+            if delay:
+                self.metrics.add('throttled')
+                self.paused[client] = time.monotonic() + delay
+                self.watch_events(client)
+                return
+
+    def resume(self):
+        """Function to read again from paused clients whose time is up"""
+        now = time.monotonic()
+        for client, until in list(self.paused.items()):
+            if until <= now and client in self.connections:
+                del self.paused[client]
+                self.watch_events(client)
+                # Messages left in the buffer would not wake the selector
+                self.parse(client)
+
+    def greet(self, client):
+        """Function to agree on framing from the first bytes, False until that is possible"""
+        reader = self.connections[client].reader
+        hello = reader.unread()
+        if hello[:1] != HELLO[:1]:
+            reader.version = LEGACY
+            return True
+        if len(hello) < len(HELLO) + 1:
+            return False
+        if hello[:len(HELLO)] != HELLO:
+            self.drop(client)
+            return False
+
+        # Settle on the highest binary version both sides know
+        reader.version = min(max(hello[len(HELLO)], BINARY), VERSION)
+        reader.skip(len(HELLO) + 1)
+        self.queues[client].version = reader.version
+        self.send(client, hello_reply(reader.version))
+        return True
+
+    def flush(self, client):
+        """Function to write as much of the send queue as the socket accepts"""
+        queue = self.queues[client]
+        try:
+            queue.send(client)
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(client)
+            return
+
+        if not queue and self.connections[client].closing:
+            self.drop(client)
+            return
+        self.watch_events(client)
+
+    def process(self, client, message):
+        """Function to handle a full message, the first being the username"""
+        if client in self.clients:
+            if not message:
+                return
+            if message[0] == '/':
+                self.run_command(message[1:], client=client)
+            else:
+                self.chat(client, message)
+            return
+
+        # Messages sent while the hub checks the username are handled once it answers
+        connection = self.connections[client]
+        if connection.backlog is not None:
+            connection.backlog.append(message)
+            return
+
+        # Only the username is expected until the client has joined
+        if connection.closing:
+            return
+
+        # Extra connections opened by a client to download in parallel
+        if message.startswith('/fetch '):
+            self.handshakes.pop(client, None)
+            # Anything else sent while the file is hashed is ignored
+            connection.backlog = []
+            self.fetch_frames(message, connection.reader.version,
+                              lambda frames: self.send_fetch(client, frames))
+            return
+
+        # Disallow duplicate username in chat, including one another client waits on the hub for
+        username = message
+        if username in self.taken_names or username in self.joining:
+            self.refuse(client)
+            return
+
+        connection.reader.max_size = MAX_MESSAGE
+        # Other workers may have the name, so ask the hub without blocking the loop
+        if self.bus is not None:
+            self.joining.add(username)
+            connection.backlog = []
+            self.claim(username, lambda ok: self.claimed(client, username, ok))
+            return
+        self.join(client, connection.address, username)
+
+    def send_fetch(self, client, frames):
+        """Function to send the answer to a data connection, then close it"""
+        if client not in self.connections:
+            for frame in frames:
+                frame.close()
+            return
+        for frame in frames:
+            self.send(client, frame)
+        self.finish(client)
+
+    def refuse(self, client):
+        """Function to turn away a client asking for a username already in use"""
+        self.broadcast('[SERVER]: Username taken', mode=3, broadcastee=client)
+        logging.info("Unicast 'Username taken' to incoming socket")
+        self.finish(client)
+
+    def claimed(self, client, username, ok):
+        """Function to finish joining once the hub answered the username claim"""
+        connection = self.connections.get(client)
+        if connection is None:
+            # The client left while waiting, so give the name back
+            self.joining.discard(username)
+            if ok:
+                self.bus.send({'op': 'release', 'name': username})
+            return
+        backlog, connection.backlog = connection.backlog, None
+        if not ok:
+            self.joining.discard(username)
+            self.refuse(client)
+            return
+        self.join(client, connection.address, username)
+        for message in backlog:
+            self.process(client, message)
+            if client not in self.connections:
+                return
+
+    def read_bus(self):
+        """Function to act on everything the hub has sent so far"""
+        messages = self.bus.pending()
+        if messages is None:
+            self.selector.unregister(self.bus.sock)
+            self.lose_hub()
+            return
+        for message in messages:
+            self.on_bus(message)
+
+    def run(self):
+        """Function to run the server on a single event loop"""
+        try:
+            while self.running:
+                now = time.monotonic()
+                wake = min(self.reap_at, now + 1)
+                if self.unflushed:
+                    wake = min(wake, self.flush_at)
+                if self.paused:
+                    wake = min(wake, min(self.paused.values()))
+                for key, events in self.selector.select(timeout=max(wake - now, 0)):
+                    sock = key.fileobj
+                    if sock is self.server:
+                        self.accept()
+                        continue
+                    if self.bus is not None and sock is self.bus.sock:
+                        self.read_bus()
+                        continue
+                    if sock is self.wake_reader:
+                        self.run_calls()
+                        continue
+                    # An earlier event in this batch may have closed the socket
+                    if events & selectors.EVENT_READ and sock in self.connections:
+                        self.read(sock)
+                    if events & selectors.EVENT_WRITE and sock in self.connections:
+                        self.flush(sock)
+                now = time.monotonic()
+                if self.paused:
+                    self.resume()
+                if now >= self.reap_at:
+                    self.reap_at = now + 1
+                    self.reap()
+                if self.unflushed and time.monotonic() >= self.flush_at:
+                    self.flush_all()
+        except KeyboardInterrupt:
+            self.kill_server()
+        # Stopped through close()
+        self.close_all()
+
+    def close_all(self):
+        """Function to close the event loop, the server socket and every client"""
+        self.selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+        super().close_all()
+
+ENGINES = {
+    'thread': Server,
+    'event': EventServer,
+}
+
+def run_worker(engine, options, log_options, bus_sock=None):
+    """Function to run one server process, one of several sharing the port when given a bus"""
+    log_listener = setup_logging(*log_options)
+    if bus_sock is not None:
+        # Workers started in the background inherit an ignored SIGINT, but
+        # stop through it when the hub goes away
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    server = ENGINES[engine](bus=None if bus_sock is None else Bus(bus_sock), **options)
+    try:
+        server.run()
+    finally:
+        # Write out whatever is still queued
+        log_listener.stop()
+
+def run_workers(count, engine, options, log_options):
+    """Function to run worker processes sharing the port, relayed through a hub in this process"""
+    root, extension = os.path.splitext(log_options[0])
+    # Forked workers would hold each other's hub sockets open and never see the
+    # hub go away, so each worker starts a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for index in range(count):
+        hub_end, worker_end = socket.socketpair()
+        # Each worker logs to its own file, and only the first adds sample files
+        worker_options = dict(options, seed=options['seed'] and index == 0)
+        # Workers each keep a copy of the history, as any of them may be asked to replay it
+        if options['history_folder']:
+            worker_options['history_folder'] = f'{options["history_folder"]}.{index + 1}'
+        worker_log = (f'{root}.{index + 1}{extension}', *log_options[1:])
+        process = context.Process(target=run_worker,
+                                  args=(engine, worker_options, worker_log, worker_end))
+        workers.append((process, hub_end, worker_end))
+
+    for process, _, worker_end in workers:
+        process.start()
+        worker_end.close()
+    hub = Hub()
+    for _, hub_end, _ in workers:
+        hub.add_worker(hub_end)
+    print(f'Started {count} workers on port {options["port"]}')
+
+    try:
+        for process, _, _ in workers:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers share the terminal's interrupt, so only stop those that did not get it
+        for process, _, _ in workers:
+            process.join(1)
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+            process.join()
+
+def make_parser():
+    """Function to return the command line parser of the server"""
+    parser = argparse.ArgumentParser(description='Run the chat server')
+    parser.add_argument('port', type=int, help='port to listen on')
+    parser.add_argument('--engine', choices=ENGINES, default='thread',
+                        help='thread: one thread per client, event: one event loop for all')
+    parser.add_argument('--queue-bytes', type=int, default=1 << 20,
+                        help='most bytes queued for one client before the overflow policy applies')
+    parser.add_argument('--queue-messages', type=int, default=1000,
+                        help='most messages queued for one client before the overflow policy applies')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default='drop-oldest',
+                        help='drop the oldest queued messages, or disconnect the slow client')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='send everything uncompressed, compressed messages are still accepted')
+    parser.add_argument('--compress-min-size', type=int, default=COMPRESS_MIN_SIZE,
+                        help='smallest message or file in bytes worth compressing')
+    parser.add_argument('--log-file', default='server.log')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='DEBUG also logs the text of every message')
+    parser.add_argument('--log-max-bytes', type=int, default=10 << 20,
+                        help='size at which the log file is rotated')
+    parser.add_argument('--log-backups', type=int, default=3,
+                        help='rotated log files kept')
+    parser.add_argument('--download-folder', default='download',
+                        help='folder holding the files offered for download')
+    parser.add_argument('--seed', action='store_true',
+                        help='add sample files to the download folder, keeping any already there')
+    parser.add_argument('--stats-file',
+                        help='append a JSON line of server stats to this file every interval')
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help='seconds between stats written to --stats-file')
+    parser.add_argument('--coalesce-ms', type=float, default=0,
+                        help='milliseconds to wait for more frames to send along with one, '
+                             'by default only what is already queued is sent together')
+    parser.add_argument('--history-folder', default='history',
+                        help='folder keeping chat messages replayed by /history')
+    parser.add_argument('--no-history', action='store_true',
+                        help='keep no chat history')
+    parser.add_argument('--history-segment-bytes', type=int, default=4 << 20,
+                        help='size at which a new history segment file is started')
+    parser.add_argument('--history-segments', type=int, default=8,
+                        help='history segment files kept, the oldest are removed first')
+    parser.add_argument('--handshake-timeout', type=float, default=10,
+                        help='seconds a new connection has to join before it is closed')
+    parser.add_argument('--ping-interval', type=float, default=30,
+                        help='seconds a client may be quiet before it is pinged')
+    parser.add_argument('--idle-timeout', type=float, default=90,
+                        help='seconds without a message or ping reply before a client is '
+                             'disconnected, 0 to never ping')
+    parser.add_argument('--message-rate', type=float, default=50,
+                        help='messages per second a client may send on average, 0 for no limit')
+    parser.add_argument('--message-burst', type=int, default=200,
+                        help='messages a client may send at once before the rate applies')
+    parser.add_argument('--byte-rate', type=float, default=1 << 20,
+                        help='bytes per second a client may send on average, 0 for no limit')
+    parser.add_argument('--byte-burst', type=int, default=MAX_MESSAGE,
+                        help='bytes a client may send at once before the rate applies')
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='most connections open at once, 0 for no limit')
+    parser.add_argument('--max-per-address', type=int, default=0,
+                        help='most connections open at once from one address, 0 for no limit')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes sharing the port, to use more than one core')
+    return parser
+
+def make_options(args):
+    """Function to turn parsed command line arguments into keyword arguments of a server"""
+    return {'port': args.port, 'queue_bytes': args.queue_bytes,
+            'queue_messages': args.queue_messages, 'overflow': args.overflow,
+            'compression': not args.no_compression,
+            'compress_min_size': args.compress_min_size,
+            'stats_file': args.stats_file, 'stats_interval': args.stats_interval,
+            'seed': args.seed, 'coalesce_window': args.coalesce_ms / 1000,
+            'history_folder': None if args.no_history else args.history_folder,
+            'history_segment_bytes': args.history_segment_bytes,
+            'history_segments': args.history_segments,
+            'handshake_timeout': args.handshake_timeout,
+            'ping_interval': args.ping_interval, 'idle_timeout': args.idle_timeout,
+            'message_rate': args.message_rate, 'message_burst': args.message_burst,
+            'byte_rate': args.byte_rate, 'byte_burst': args.byte_burst,
+            'max_connections': args.max_connections,
+            'max_per_address': args.max_per_address,
+            'download_folder': args.download_folder}
+
 if __name__ == '__main__':
-    if len(sys.argv) <= 1:
-        print('Need 1 arguments')
-        sys.exit(0)
+    parser = make_parser()
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT, which this platform does not have')
 
-    server = Server(port=int(sys.argv[1]))
-    server.run()
-    
\ No newline at end of file
+    server_options = make_options(args)
+    logging_options = (args.log_file, args.log_level, args.log_max_bytes, args.log_backups)
+    if args.workers > 1:
+        run_workers(args.workers, args.engine, server_options, logging_options)
+    else:
+        run_worker(args.engine, server_options, logging_options)